@@ -14,14 +14,19 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from nba import api
+from nba.aggregates import RunningStats
+from nba import cache_manager
 from nba import cli
 from nba import log
+from nba import response_cache
+from nba import search
 from nba import state
 from nba import storage
 from nba import utils
 
 from nba import Player
 from nba import PlayerGameStats
+from nba import StatsTable
 from nba import Team
 
 import aiohttp
@@ -37,40 +42,77 @@ import sys
 LOCAL_STORAGE = pathlib.Path(os.environ["HOME"]) / ".nba"
 
 
-def load_players():
-    players = []
-    path = LOCAL_STORAGE / "players.json"
-    if path.exists():
-        players_json = storage.load_json(path)
-        players = [Player(**obj) for obj in players_json]
-    return players
+# local database, opened once the storage directory exists
+database = None
+# local storage manager, tracks freshness/hit rates and evicts stored data
+cache = None
 
 
-def store_players(players):
-    path = LOCAL_STORAGE / "players.json"
-    players_json = [player.toJSON() for player in players]
-    storage.store_json(path, players_json)
+async def find_players(names):
+    # only use players which have been refreshed recently, as players are
+    # traded between teams
+    players_json = await database.run(
+        database.find_players, names, cache.ttl("players"))
+    return [Player(**obj) for obj in players_json]
+
+
+async def search_players(names):
+    # fuzzy search of the stored players, for misspelled/unaccented names
+    ranked = await database.run(
+        database.search_players, " ".join(names), cache.ttl("players"))
+    return [(score, Player(**obj)) for score, obj in ranked]
+
+
+async def store_players():
+    # only flush the players which were added or changed during this run
+    players = state.pop_dirty_players()
+    if players:
+        players_json = [player.toJSON() for player in players]
+        await database.run(database.store_players, players_json)
 
 
 async def get_player(args, session):
     player = None
     log.debug("searching for player: %s" % " ".join(args.name))
-    # check if the player is already stored in the state
+    # check if the player is already stored locally, only the matching players
+    # are loaded into the state
+    state.add_players(await find_players(args.name), dirty=False)
     players = state.filter_players(args.name)
     if len(players) == 1:
+        cache.record("players", True)
         return players[0]
+    # if there are no exact matches, search the stored players for accent or
+    # punctuation variants of the name, otherwise the API is queried and any
+    # similar stored players are only suggested
+    ranked = []
+    if not players:
+        ranked = await search_players(args.name)
+        player = search.best_match(ranked)
+        if player is not None:
+            cache.record("players", True)
+            log.debug("closest match: %s" % player.full_name)
+            state.add_players([player], dirty=False)
+            return player
+    cache.record("players", False)
     # otherwise query the API to grab the missing player or any matches that
     # are not already stored in the state
     responses = await utils.await_and_gather(
         api.get_players(session, name=name) for name in args.name)
-    players.extend(
-        Player(**obj) for obj in itertools.chain.from_iterable(responses))
-    # add all players to the state and then re-filter
+    fetched = [
+        Player(**obj) for obj in itertools.chain.from_iterable(responses)]
+    players.extend(fetched)
+    # add all players to the state and then re-filter, players which are
+    # unchanged are not stored again but are marked as up-to-date
     state.add_players(players)
+    await database.run(
+        database.touch_players, [player.id for player in fetched])
     matches = state.filter_players(args.name)
     # check if the player was not found
     if not matches:
         log.error("failed to find player \"%s\"" % " ".join(args.name))
+        if ranked:
+            match_names = [player.full_name for _, player in ranked]
+            log.info("did you mean one of:\n%s" % "\n".join(match_names))
     # check if there are too many matches
     elif len(matches) > 1:
         log.error("multiple player matches for \"%s\"" % " ".join(args.name))
@@ -83,15 +125,15 @@ async def get_player(args, session):
 
 
 async def get_teams(session):
-    teams_json = []
-    path = LOCAL_STORAGE / "teams.json"
-    # check if the team information is already stored locally
-    if path.exists():
-        teams_json = storage.load_json(path)
+    # check if the team information is already stored locally and fresh
+    teams_json = None
+    if cache.is_fresh("teams", await database.run(database.get_teams_updated)):
+        teams_json = await database.run(database.load_teams)
+    cache.record("teams", bool(teams_json))
     # otherwise, grab via the API and store locally
-    else:
+    if not teams_json:
         teams_json = await api.get_all_teams(session)
-        storage.store_json(path, teams_json)
+        await database.run(database.store_teams, teams_json)
     teams = [Team(**obj) for obj in teams_json]
     return teams
 
@@ -117,30 +159,161 @@ def get_team(key):
     return team
 
 
-async def get_player_game_stats_for_season(session, player_id, season):
-    stats_json = []
-    path = LOCAL_STORAGE / ("player_%s_games_%s.json" % (player_id, season))
-    # always get the current stats if the current season is requested
-    is_curr_season = season == utils.get_current_season()
-    if not is_curr_season and path.exists():
-        stats_json = storage.load_json(path)
-    else:
+def load_player_game_stats_json(player_id, season):
+    # runs on the database thread, see Database.run
+    return cache.load_player_game_stats(player_id, season)
+
+
+async def is_player_season_stored(player_id, season):
+    # previous seasons are refetched once they expire, and once after they
+    # end if they were stored while in progress
+    return await database.run(
+        database.has_player_game_stats, player_id, season,
+        cache.ttl("historical"), True)
+
+
+async def has_player_game_stats(player_id, season):
+    stored = await is_player_season_stored(player_id, season)
+    cache.record("historical", stored)
+    return stored
+
+
+async def sync_season(session, player_id, season):
+    # seasons which have not ended i.e. the current season are stored locally,
+    # later runs only fetch the games since the most recent stored game and
+    # merge them into the store
+    # skip syncing if the season was synced recently
+    fresh = await database.run(
+        database.has_player_game_stats, player_id, season,
+        cache.ttl("current"))
+    cache.record("current", fresh)
+    if fresh:
+        return
+    mark = await database.run(
+        database.get_player_game_stats_mark, player_id, season)
+    if mark is None:
         stats_json = await api.get_player_game_stats(
             session, player_id, season)
-        # only flush if a previous season was requested
-        if not is_curr_season:
-            storage.store_json(path, stats_json)
-    stats = [PlayerGameStats(**obj) for obj in stats_json]
-    return stats
+        await database.run(
+            database.store_player_game_stats, player_id, season, stats_json,
+            False)
+        return
+    # re-fetch the date of the most recent stored game, as its stats may have
+    # been stored while the game was in progress
+    start_date = mark[0][:10]
+    log.debug("syncing games since %s" % start_date)
+    stats_json = await api.get_player_game_stats(
+        session, player_id, season, start_date=start_date)
+    await database.run(
+        database.merge_player_game_stats, player_id, season, stats_json)
+    await database.run(database.refresh_player_season, player_id, season)
+
+
+def store_player_game_stats_json(player_id, seasons, stats_json):
+    # runs on the database thread, see Database.run
+    seasons_json = api.split_by_season(stats_json)
+    for season in seasons:
+        cache.store_player_game_stats(
+            player_id, season, seasons_json.get(season, []),
+            utils.is_season_over(season))
+
+
+async def load_stored_season(player_id, season):
+    # loads a previous season if it is stored, without recording a hit/miss
+    if not await is_player_season_stored(player_id, season):
+        return None
+    return await database.run(load_player_game_stats_json, player_id, season)
+
+
+async def iter_player_game_stats_newest_first(session, player_id, seasons):
+    # yields the player game stats from newest to oldest so that callers which
+    # only need the most recent games can stop early, seasons are loaded one at
+    # a time and stats objects are only constructed for the consumed games
+    seasons = sorted(seasons, reverse=True)
+    fetched = set()
+    # season and task loading the next stored season while the network is
+    # awaited for this season
+    prefetch = None
+
+    def prefetch_season(i):
+        # seasons fetched alongside this season are stored once it is fetched
+        for season in seasons[i + 1:]:
+            if not utils.is_season_over(season):
+                return None
+            if season not in fetched:
+                return season, asyncio.ensure_future(
+                    load_stored_season(player_id, season))
+        return None
+
+    try:
+        for i, season in enumerate(seasons):
+            stats_json = None
+            if prefetch is not None and prefetch[0] == season:
+                stats_json = await prefetch[1]
+                prefetch = None
+            if stats_json is not None:
+                cache.record("historical", True)
+            elif not utils.is_season_over(season):
+                prefetch = prefetch_season(i)
+                await sync_season(session, player_id, season)
+            elif season in fetched:
+                pass
+            elif not await has_player_game_stats(player_id, season):
+                # uncached previous seasons are only fetched once they are
+                # needed, and then all at once in a single query
+                missing = [season] + [
+                    s for s in seasons[i + 1:] if utils.is_season_over(s)
+                    and not await is_player_season_stored(player_id, s)]
+                # the other missing seasons are skipped once they are reached
+                fetched.update(missing[1:])
+                for _ in missing[1:]:
+                    cache.record("historical", False)
+                prefetch = prefetch_season(i)
+                missing_json = await api.get_player_game_stats(
+                    session, player_id, missing)
+                await database.run(
+                    store_player_game_stats_json, player_id, missing,
+                    missing_json)
+            # stored stats are sorted chronologically
+            if stats_json is None:
+                stats_json = await database.run(
+                    load_player_game_stats_json, player_id, season)
+            for obj in reversed(stats_json):
+                yield PlayerGameStats(**obj)
+    finally:
+        if prefetch is not None:
+            prefetch[1].cancel()
+
+
+def load_player_season_aggregates(player_id, season):
+    # runs on the database thread, see Database.run
+    # the aggregates are materialized the first time they are needed, and
+    # then reused until games are merged into the season
+    aggregates = database.load_player_season_aggregates(player_id, season)
+    if aggregates is None:
+        stats_json = load_player_game_stats_json(player_id, season)
+        table = StatsTable.from_stats(
+            PlayerGameStats(**obj) for obj in stats_json or [])
+        # filter out DNPs
+        played = table.without_dnp()
+        aggregates = {
+            "games": len(played),
+            "dnp": len(table) - len(played),
+            "sums": played.sums(),
+        }
+        if stats_json is not None:
+            database.store_player_season_aggregates(
+                player_id, season, **aggregates)
+    else:
+        cache.access(player_id, season)
+    return RunningStats.from_sums(aggregates["sums"], aggregates["games"])
 
 
 async def get_player_season_averages(session, player_id):
-    # get the player game stats for the current season
+    # get the player season totals for the current season
     season = utils.get_current_season()
-    season_stats = await get_player_game_stats_for_season(
-        session, player_id, season)
-    # combine the averages and filter out DNPs
-    return PlayerGameStats.average(season_stats, filter_dnp=True)
+    await sync_season(session, player_id, season)
+    return await database.run(load_player_season_aggregates, player_id, season)
 
 
 async def player_season_averages(args, session):
@@ -149,31 +322,33 @@ async def player_season_averages(args, session):
     if player is None:
         return
 
-    # grab the player season averages for the current season
-    averages = await get_player_season_averages(session, player.id)
-    if not averages:
+    # grab the player season stats for the current season
+    season = await get_player_season_averages(session, player.id)
+    if not len(season):
+        log.info("no games found")
         return
-    # derive shooting percentages manually
-    fg_pct = utils.percentage(averages.fgm, averages.fga)
-    fg3_pct = utils.percentage(averages.fg3m, averages.fg3a)
-    ft_pct = utils.percentage(averages.ftm, averages.fta)
+    averages = season.means()
+    # derive shooting percentages from the season totals
+    fg_pct = season.percentage("fg_pct")
+    fg3_pct = season.percentage("fg3_pct")
+    ft_pct = season.percentage("ft_pct")
 
     # print player name/position/team info
     log.info(player.bio())
     # print player season averages
-    log.info("%s GP %0.1f MPG" % (averages.gp, averages.min))
+    log.info("%s GP %0.1f MPG" % (len(season), averages["min"]))
     log.info(
         "%.1f pts %.1f reb %.1f ast"
-        % (averages.pts, averages.reb, averages.ast))
+        % (averages["pts"], averages["reb"], averages["ast"]))
     log.info(
         "%.1f%% FG (%.1f FGM / %.1f FGA)"
-        % (fg_pct, averages.fgm, averages.fga))
+        % (fg_pct, averages["fgm"], averages["fga"]))
     log.info(
         "%.1f%% 3PT (%.1f 3PTM / %.1f 3PTA)"
-        % (fg3_pct, averages.fg3m, averages.fg3a))
+        % (fg3_pct, averages["fg3m"], averages["fg3a"]))
     log.info(
         "%.1f%% FT (%.1f FT / %.1f FTA)"
-        % (ft_pct, averages.ftm, averages.fta))
+        % (ft_pct, averages["ftm"], averages["fta"]))
 
 
 async def player_game_log(args, session):
@@ -189,14 +364,14 @@ async def player_game_log(args, session):
             return
 
     # grab the player statistics for the current season and previous seasons,
-    # as requested by the lookback argument
+    # as requested by the lookback argument, from newest to oldest
     curr_season = utils.get_current_season()
-    responses = await utils.await_and_gather(
-        get_player_game_stats_for_season(session, player.id, season)
-        for season in range(curr_season - args.lookback, curr_season + 1))
-    game_stats = list(itertools.chain.from_iterable(responses))
-    # sort chronologically
-    game_stats = sorted(game_stats, key=lambda g: g.game.date_to_datetime())
+    seasons = range(curr_season - args.lookback, curr_season + 1)
+    # nothing is loaded if no games were requested
+    if args.ngames <= 0:
+        seasons = []
+    game_stats = iter_player_game_stats_newest_first(
+        session, player.id, seasons)
 
     # print player name/position/team info
     log.info(player.bio())
@@ -206,11 +381,9 @@ async def player_game_log(args, session):
     # track the objects for each game so that they can be averaged and that the
     # logging stops after the correct number of games have been logged
     games = []
-    # print player stats for each game
-    # reverse so the report is newest-to-oldest
-    for stats in reversed(game_stats):
-        if len(games) >= args.ngames:
-            break
+    # print player stats for each game, newest-to-oldest, stopping once the
+    # requested number of games has been found
+    async for stats in game_stats:
         # skip the game if it is a DNP
         if stats.is_dnp():
             continue
@@ -241,32 +414,69 @@ async def player_game_log(args, session):
             cols.append("%u-%u FT" % (stats.ftm, stats.fta))
         table.append(cols)
         games.append(stats)
+        if len(games) >= args.ngames:
+            break
+    # stop any remaining requests
+    await game_stats.aclose()
     # before printing averages, check if there were any matching games
     if not games:
         log.info("no games found")
         return
     # derive the averages for the games and log
     averages_row = ["AVERAGES"]
-    averages = PlayerGameStats.average(games)
-    averages_row.append("%.1f" % averages.pts)
-    averages_row.append("%.1f" % averages.reb)
-    averages_row.append("%.1f" % averages.ast)
+    games_table = StatsTable.from_stats(games)
+    averages_row.append("%.1f" % games_table.mean("pts"))
+    averages_row.append("%.1f" % games_table.mean("reb"))
+    averages_row.append("%.1f" % games_table.mean("ast"))
     # only print points/rebounds/assists if basic flag is given
     if not args.basic:
-        averages_row.append(
-            "%.1f%%" % utils.percentage(averages.fgm, averages.fga))
-        averages_row.append(
-            "%.1f%%" % utils.percentage(averages.fg3m, averages.fg3a))
-        averages_row.append(
-            "%.1f%%" % utils.percentage(averages.ftm, averages.fta))
+        averages_row.append("%.1f%%" % games_table.percentage("fg_pct"))
+        averages_row.append("%.1f%%" % games_table.percentage("fg3_pct"))
+        averages_row.append("%.1f%%" % games_table.percentage("ft_pct"))
     table.append(averages_row)
     # print the game log
     utils.print_table(log.info, table)
 
 
+def cache_usage(args):
+    # runs on the database thread, see Database.run
+    if args.max_size is not None:
+        cache.set_max_size(args.max_size * 1024 * 1024)
+    if args.columnar is not None:
+        cache.set_columnar(args.columnar == "on")
+    if args.compact:
+        result = cache.compact()
+        log.info(
+            "removed %u expired and %u least-recently-used player seasons, "
+            "%u legacy files"
+            % (result["expired"], result["evicted"], result["removed"]))
+    usage = cache.usage()
+    log.info(
+        "local storage: %s of %s"
+        % (utils.format_size(usage["total"]),
+           utils.format_size(usage["max_size"])))
+    log.info(
+        "database: %s (%u teams, %u players, %u player seasons, %u games)"
+        % (utils.format_size(usage["database"]), usage["teams"],
+           usage["players"], usage["player_seasons"], usage["games"]))
+    if cache.use_columnar or usage["columnar_files"]:
+        log.info(
+            "columnar: %s (%u files)"
+            % (utils.format_size(usage["columnar"]), usage["columnar_files"]))
+    log.info(
+        "responses: %s (%u files)"
+        % (utils.format_size(usage["responses"]), usage["response_files"]))
+    log.info("page counts: %s" % utils.format_size(usage["pages"]))
+    # print hit rates as tabular data
+    table = []
+    for kind, (hits, misses) in usage["hits"].items():
+        rate = utils.percentage(hits, hits + misses)
+        table.append([
+            kind, "%u hits" % hits, "%u misses" % misses, "%.1f%%" % rate])
+    utils.print_table(log.info, table)
+
+
 async def run(args, session):
-    # load stored NBA player info
-    state.set_players(load_players())
     # load NBA teams info
     state.set_teams(await get_teams(session))
 
@@ -276,20 +486,46 @@ async def run(args, session):
         await player_game_log(args, session)
 
     # flush NBA player info to local storage
-    store_players(state.players)
+    await store_players()
 
 
 async def main(args):
+    global cache
+    global database
     # create the local storage directory, if it does not already exist
     LOCAL_STORAGE.mkdir(exist_ok=True)
+    # open the local database
+    database = storage.open_database(LOCAL_STORAGE)
+    responses = response_cache.ResponseCache(LOCAL_STORAGE / "http")
+    cache = cache_manager.CacheManager(
+        database, LOCAL_STORAGE, responses=responses)
+    # the cache command only uses local storage
+    if args.command == "cache":
+        try:
+            await database.run(cache_usage, args)
+        finally:
+            database.close()
+        return
     # open the HTTP session and catch exceptions at the top level
     try:
         async with aiohttp.ClientSession(
             base_url=api.BASE_URL, headers=api.HEADERS, raise_for_status=True,
         ) as session:
-            await run(args, session)
-    except aiohttp.ClientResponseError as ex:
+            page_counts = storage.PageCounts(
+                LOCAL_STORAGE / cache_manager.PAGE_COUNTS)
+            api.configure(session, cache=responses, page_counts=page_counts)
+            await page_counts.load_async()
+            try:
+                await run(args, session)
+            finally:
+                page_counts.flush()
+                # store hit rates/accesses and evict if over the maximum size
+                await database.run(cache.flush)
+    except (aiohttp.ClientResponseError, aiohttp.ClientConnectionError) as ex:
         log.error("failed to retrieve data from the server: %s" % ex)
+    finally:
+        responses.close()
+        database.close()
 
 
 if __name__ == "__main__":
@@ -20,6 +20,8 @@ from .objects.player import Player
 from .objects.player_game_stats import PlayerGameStats
 from .objects.team import Team
 
+from .stats_table import StatsTable
+
 import logging
 
 __version__ = "0.3.6"
@@ -0,0 +1,241 @@
+# Copyright (C) 2022  Ian Brault
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from .stats_table import SHOOTING_FIELDS
+from .stats_table import STAT_FIELDS
+
+import collections
+import operator
+
+# sizes of the default rolling windows, in games
+WINDOWS = (5, 10, 20)
+
+_get_stats = operator.attrgetter(*STAT_FIELDS)
+
+
+def game_values(stats):
+    """
+    Gets the counting stats for a game, missing stats count as 0.
+
+    Arguments:
+        stats : PlayerGameStats object
+
+    Returns:
+        a tuple of values, in STAT_FIELDS order
+    """
+    return tuple(0 if v is None else v for v in _get_stats(stats))
+
+
+class RunningStats:
+    """
+    Running totals of the counting stats over a set of games, updated as games
+    are added/removed rather than recomputed.
+    """
+
+    def __init__(self):
+        self.sums = [0] * len(STAT_FIELDS)
+        self.ngames = 0
+
+    @classmethod
+    def from_sums(cls, sums, ngames):
+        """
+        Builds running totals from precomputed sums.
+
+        Arguments:
+            sums   : Dict mapping each of STAT_FIELDS to its total
+            ngames : Number of games summed
+
+        Returns:
+            the RunningStats object
+        """
+        running = cls()
+        running.sums = [sums[field] for field in STAT_FIELDS]
+        running.ngames = ngames
+        return running
+
+    def __len__(self):
+        return self.ngames
+
+    def add(self, values):
+        self.sums = list(map(operator.add, self.sums, values))
+        self.ngames += 1
+
+    def remove(self, values):
+        self.sums = list(map(operator.sub, self.sums, values))
+        self.ngames -= 1
+
+    def sum(self, field):
+        return self.sums[STAT_FIELDS.index(field)]
+
+    def mean(self, field):
+        if not self.ngames:
+            return 0.0
+        return self.sum(field) / self.ngames
+
+    def means(self):
+        return {field: self.mean(field) for field in STAT_FIELDS}
+
+    def percentage(self, field):
+        """
+        Gets a shooting percentage over all games, see StatsTable.percentage.
+        """
+        makes, attempts = SHOOTING_FIELDS[field]
+        total = self.sum(attempts)
+        if total == 0:
+            return 0.0
+        return self.sum(makes) / total * 100.0
+
+
+class RollingWindow(RunningStats):
+    """
+    Running totals over the most recent games, the oldest game drops out as
+    each new game is added.
+    """
+
+    def __init__(self, size):
+        super().__init__()
+        self.size = size
+        # (game ID, values) tuples, oldest first
+        self.games = collections.deque()
+
+    def push(self, game_id, values):
+        self.games.append((game_id, values))
+        self.add(values)
+        if len(self.games) > self.size:
+            _, oldest = self.games.popleft()
+            self.remove(oldest)
+
+    def replace(self, game_id, values):
+        """
+        Replaces the values of a game in the window, if it is in the window.
+        """
+        for i, (other_id, old) in enumerate(self.games):
+            if other_id == game_id:
+                self.games[i] = (game_id, values)
+                self.remove(old)
+                self.add(values)
+                return
+
+
+class PlayerAggregates:
+    """
+    Season totals, rolling windows over the most recent games, and home/away
+    and per-opponent splits for a player, maintained incrementally: adding a
+    game updates every aggregate in constant time, without revisiting the
+    earlier games. DNPs are counted but excluded from the aggregates.
+
+    Games are expected to be added in chronological order. Re-adding a game,
+    i.e. after its stats were updated, replaces it. Adding a game older than
+    the most recent one rebuilds the rolling windows.
+    """
+
+    def __init__(self, windows=WINDOWS):
+        self.totals = RunningStats()
+        self.windows = {size: RollingWindow(size) for size in windows}
+        self.home = RunningStats()
+        self.away = RunningStats()
+        # running totals by opponent team ID
+        self.opponents = collections.defaultdict(RunningStats)
+        self.dnp_ids = set()
+        # games added, excluding DNPs, by game ID, as (sort key, values,
+        # splits) tuples
+        self.games = {}
+        self.last_key = None
+
+    def split(self, stats):
+        """
+        Gets the splits that a game belongs to.
+
+        Returns:
+            a tuple of True if the player was at home, and the opponent ID
+        """
+        game = stats.game
+        team_id = stats.team.id if stats.team is not None else None
+        is_home = team_id == game.home_team_id
+        opponent_id = game.visitor_team_id if is_home else game.home_team_id
+        return is_home, opponent_id
+
+    def _apply(self, values, splits, remove=False):
+        is_home, opponent_id = splits
+        for running in [
+            self.totals, self.home if is_home else self.away,
+            self.opponents[opponent_id],
+        ]:
+            if remove:
+                running.remove(values)
+            else:
+                running.add(values)
+
+    def add(self, stats):
+        """
+        Adds a game to the aggregates.
+
+        Arguments:
+            stats : PlayerGameStats object
+        """
+        game_id = stats.game.id
+        old = self.games.pop(game_id, None)
+        if old is not None:
+            self._apply(old[1], old[2], remove=True)
+        if stats.is_dnp():
+            self.dnp_ids.add(game_id)
+            if old is not None:
+                self.rebuild_windows()
+            return
+        self.dnp_ids.discard(game_id)
+        values = game_values(stats)
+        splits = self.split(stats)
+        key = stats.game.sort_key
+        self.games[game_id] = (key, values, splits)
+        self._apply(values, splits)
+        if old is not None:
+            for window in self.windows.values():
+                window.replace(game_id, values)
+            return
+        if self.last_key is not None and key < self.last_key:
+            self.rebuild_windows()
+            return
+        self.last_key = key
+        for window in self.windows.values():
+            window.push(game_id, values)
+
+    def extend(self, stats_list):
+        """
+        Adds games to the aggregates, in chronological order.
+
+        Arguments:
+            stats_list : List of PlayerGameStats objects
+        """
+        for stats in stats_list:
+            self.add(stats)
+
+    def rebuild_windows(self):
+        games = sorted(self.games.items(), key=lambda item: item[1][0])
+        self.last_key = games[-1][1][0] if games else None
+        for size, window in self.windows.items():
+            window = RollingWindow(size)
+            for game_id, (_, values, _) in games[-size:]:
+                window.push(game_id, values)
+            self.windows[size] = window
+
+    @property
+    def dnp(self):
+        return len(self.dnp_ids)
+
+    def window(self, size):
+        return self.windows[size]
+
+    def opponent(self, team_id):
+        return self.opponents.get(team_id) or RunningStats()
@@ -13,11 +13,20 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from . import codec
 from . import log
+from . import response_cache
+from . import throttle
+
+import aiohttp
+import yarl
 
 import asyncio
 import collections
 import itertools
+import random
+import time
+import weakref
 
 BASE_URL = "https://www.balldontlie.io"
 HEADERS = {
@@ -25,6 +34,84 @@ HEADERS = {
     "User-Agent": "python-requests/2.28.1",
 }
 RESULTS_PER_PAGE = 100
+# query parameters which bound the dates of the results
+DATE_PARAMS = ("start_date", "end_date")
+# maximum length of a request URL, including the base URL
+MAX_URL_LENGTH = 2048
+# upper bound on the number of concurrent requests made through a session
+MAX_CONCURRENCY = 16
+# server request budget: RATE_LIMIT requests per RATE_PERIOD seconds, of which
+# up to RATE_BURST can be made back-to-back
+RATE_LIMIT = 60
+RATE_PERIOD = 60.0
+RATE_BURST = 10
+# retries for failed requests, with jittered exponential backoff (in seconds)
+MAX_RETRIES = 4
+RETRY_BACKOFF = 0.5
+RETRY_BACKOFF_MAX = 30.0
+
+# per-session request state, shared by every request made through a session
+_sessions = weakref.WeakKeyDictionary()
+
+
+class SessionState:
+    """
+    Request state shared across all requests made through a ClientSession.
+    """
+
+    def __init__(
+        self,
+        max_concurrency=MAX_CONCURRENCY, rate_limit=RATE_LIMIT,
+        rate_period=RATE_PERIOD, rate_burst=RATE_BURST,
+        max_retries=MAX_RETRIES, cache=None, page_counts=None,
+    ):
+        self.limiter = throttle.AdaptiveLimiter(max_concurrency)
+        # a rate limit of None disables client-side rate limiting
+        self.bucket = None
+        if rate_limit:
+            self.bucket = throttle.TokenBucket.for_budget(
+                rate_limit, rate_period, rate_burst)
+        self.max_retries = max_retries
+        # optional ResponseCache object
+        self.cache = cache
+        # requests in flight, by normalized URL, shared by identical requests
+        self.pending = {}
+        # optional storage.PageCounts object
+        self.page_counts = page_counts
+
+
+def configure(session, **kwargs):
+    """
+    Configures the request state for the given session. Any options that are
+    not provided use the module defaults.
+
+    Arguments:
+        session : aiohttp.ClientSession object
+        kwargs  : SessionState options i.e. max_concurrency, rate_limit,
+                  cache, page_counts
+
+    Returns:
+        the SessionState object
+    """
+    _sessions[session] = SessionState(**kwargs)
+    return _sessions[session]
+
+
+def get_session_state(session):
+    """
+    Gets the request state for the given session, using the defaults if the
+    session has not been configured.
+
+    Arguments:
+        session : aiohttp.ClientSession object
+
+    Returns:
+        the SessionState object
+    """
+    state = _sessions.get(session)
+    if state is None:
+        state = configure(session)
+    return state
 
 
 def build_url(base, **kwargs):
@@ -52,9 +139,135 @@ def build_url(base, **kwargs):
     return "%s?%s" % (base, "&".join(param_strs))
 
 
-async def get_json(session, url, data=False,**kwargs):
+def is_retryable(ex):
+    """
+    Checks if a failed request should be retried.
+
+    Arguments:
+        ex : Exception raised by the request
+
+    Returns:
+        True if the request failed due to throttling, a server error, or a
+        connection issue
+    """
+    if isinstance(ex, aiohttp.ClientResponseError):
+        return ex.status == 429 or ex.status >= 500
+    return isinstance(
+        ex, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+
+def retry_delay(ex, attempt):
     """
-    Performs a GET request for JSON data.
+    Gets the delay before retrying a failed request. Uses the server-provided
+    Retry-After delay if there is one, otherwise a "full jitter" exponential
+    backoff so that concurrent retries are spread out.
+
+    Arguments:
+        ex      : Exception raised by the request
+        attempt : Number of attempts made so far
+
+    Returns:
+        the delay in seconds
+    """
+    headers = getattr(ex, "headers", None) or {}
+    try:
+        return min(float(headers["Retry-After"]), RETRY_BACKOFF_MAX)
+    except (KeyError, TypeError, ValueError):
+        pass
+    backoff = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** attempt)
+    return random.uniform(0, backoff)
+
+
+async def request_json(session, url, headers=None):
+    """
+    Performs a single rate-limited GET request for JSON data.
+
+    Arguments:
+        session : aiohttp.ClientSession object
+        url     : Full URL string, including query parameters
+        headers : Additional request headers
+
+    Returns:
+        a tuple of the response status, the response headers, and the
+        retrieved JSON data (None if the response was 304 Not Modified)
+    """
+    state = get_session_state(session)
+    if state.bucket is not None:
+        await state.bucket.acquire()
+    await state.limiter.acquire()
+    log.debug("query: %s%s" % (BASE_URL, url))
+    start = time.monotonic()
+    throttled = False
+    try:
+        async with session.get(url, headers=headers) as rsp:
+            body = None if rsp.status == 304 else codec.loads(await rsp.read())
+            return rsp.status, rsp.headers, body
+    except aiohttp.ClientResponseError as ex:
+        throttled = ex.status == 429
+        raise
+    finally:
+        state.limiter.release(time.monotonic() - start, throttled=throttled)
+
+
+async def fetch_json(session, url, headers=None):
+    """
+    Performs a GET request for JSON data. Requests that fail due to throttling,
+    server errors, or connection issues are retried with backoff.
+
+    Arguments:
+        session : aiohttp.ClientSession object
+        url     : Full URL string, including query parameters
+        headers : Additional request headers
+
+    Returns:
+        a tuple of the response status, the response headers, and the
+        retrieved JSON data (None if the response was 304 Not Modified)
+    """
+    max_retries = get_session_state(session).max_retries
+    attempt = 0
+    while True:
+        try:
+            return await request_json(session, url, headers=headers)
+        except Exception as ex:
+            if attempt >= max_retries or not is_retryable(ex):
+                raise
+            delay = retry_delay(ex, attempt)
+            attempt += 1
+            log.debug(
+                "retrying %s in %.1fs (attempt %u/%u): %s"
+                % (url, delay, attempt, max_retries, ex))
+            await asyncio.sleep(delay)
+
+
+class SharedRequest:
+    """
+    A request shared by any number of waiters. Cancelling a waiter does not
+    cancel the request for the others, but the request is cancelled once every
+    waiter has been cancelled.
+    """
+
+    def __init__(self, coro):
+        self.task = asyncio.ensure_future(coro)
+        self.waiters = 0
+        self.abandoned = False
+
+    async def wait(self):
+        self.waiters += 1
+        try:
+            return await asyncio.shield(self.task)
+        except asyncio.CancelledError:
+            if self.waiters == 1 and not self.task.done():
+                self.abandoned = True
+                self.task.cancel()
+            raise
+        finally:
+            self.waiters -= 1
+
+
+async def get_json(session, url, data=False, **kwargs):
+    """
+    Performs a GET request for JSON data. Concurrent identical requests share a
+    single underlying request and its result.
 
     Arguments:
         session : aiohttp.ClientSession object
@@ -63,15 +276,157 @@ async def get_json(session, url, data=False,**kwargs):
         kwargs  : Query parameters
 
     Returns:
-        the retrieved JSON data, or {} if an error was encountered
+        the retrieved JSON data
     """
     url = build_url(url, **kwargs)
-    log.debug("query: %s%s" % (BASE_URL, url))
-    async with session.get(url) as rsp:
-        rsp = await rsp.json()
-        if data:
-            rsp = rsp["data"]
+    pending = get_session_state(session).pending
+    key = response_cache.normalize_url(url)
+    request = pending.get(key)
+    if request is None or request.abandoned:
+        request = SharedRequest(load_json(session, url))
+        pending[key] = request
+
+        def on_done(task, request=request):
+            # an abandoned request may already have been replaced by a new
+            # request for the same URL
+            if pending.get(key) is request:
+                del pending[key]
+            # mark the exception as retrieved in case every waiter was
+            # cancelled before the request completed
+            if not task.cancelled():
+                task.exception()
+
+        request.task.add_done_callback(on_done)
+    else:
+        log.debug("coalesced: %s%s" % (BASE_URL, url))
+    rsp = await request.wait()
+    if data:
+        rsp = rsp["data"]
+    return rsp
+
+
+async def load_json(session, url):
+    """
+    Loads JSON data for a URL. Responses are served from the session response
+    cache, if one is configured, while they are fresh.
+
+    Arguments:
+        session : aiohttp.ClientSession object
+        url     : Full URL string, including query parameters
+
+    Returns:
+        the retrieved JSON data
+    """
+    cache = get_session_state(session).cache
+    if cache is None:
+        _, _, rsp = await fetch_json(session, url)
         return rsp
+    return await get_cached_json(session, cache, url)
+
+
+async def get_cached_json(session, cache, url):
+    """
+    Gets JSON data through the response cache. Stale entries are revalidated
+    using their ETag/Last-Modified validators when the server provided them.
+
+    Arguments:
+        session : aiohttp.ClientSession object
+        cache   : ResponseCache object
+        url     : Full URL string, including query parameters
+
+    Returns:
+        the retrieved JSON data
+    """
+    # cache entries are read and written on the cache thread
+    key = response_cache.normalize_url(url)
+    entry = await cache.run(cache.get, key)
+    if entry is not None and cache.is_fresh(entry):
+        log.debug("cached: %s%s" % (BASE_URL, url))
+        return entry.body
+    headers = entry.validators() if entry is not None else None
+    status, rsp_headers, body = await fetch_json(session, url, headers=headers)
+    if status == 304 and entry is not None:
+        await cache.run(cache.revalidate, entry)
+        return entry.body
+    await cache.run(
+        cache.put, key, body, rsp_headers.get("ETag"),
+        rsp_headers.get("Last-Modified"))
+    return body
+
+
+async def iter_paginated(
+    session, base_url, ordered=False, records=False, **kwargs,
+):
+    """
+    Performs a series of GET requests for paginated data, yielding each page as
+    soon as it is retrieved. The remaining requests are cancelled if the
+    generator is closed before it is exhausted.
+
+    Arguments:
+        session  : aiohttp.ClientSession object
+        base_url : Base URL
+        ordered  : Yield pages in page order, rather than in arrival order
+        records  : Yield individual records, rather than pages
+        kwargs   : Query parameters (excluding pagination arguments)
+
+    Yields:
+        the data for each page as a list of JSON objects, or each JSON object
+        if the records argument is set
+    """
+    args = kwargs.copy()
+    args["per_page"] = RESULTS_PER_PAGE
+    # if the page count for this query is known from a previous run, request
+    # the remaining pages alongside the initial request rather than waiting
+    # for it to report the page count, date-bounded queries i.e. syncs are
+    # not repeated and are not remembered
+    page_counts = get_session_state(session).page_counts
+    if any(param in args for param in DATE_PARAMS):
+        page_counts = None
+    key = response_cache.normalize_url(build_url(base_url, **args))
+    guess = page_counts.get(key) if page_counts is not None else None
+    tasks = []
+
+    def request_pages(pages):
+        for page in pages:
+            tasks.append(asyncio.ensure_future(
+                get_json(session, base_url, page=page, **args)))
+
+    try:
+        if guess:
+            request_pages(range(2, guess + 1))
+        # perform the initial request
+        req = await get_json(session, base_url, **args)
+        total_pages = req["meta"]["total_pages"]
+        if page_counts is not None:
+            page_counts.set(key, total_pages)
+        if records:
+            for obj in req["data"]:
+                yield obj
+        else:
+            yield req["data"]
+        # drop speculative requests for pages that do not exist, and perform
+        # requests for any remaining pages concurrently, the session limiter
+        # bounds how many of these are in flight at once
+        if not req["meta"]["next_page"]:
+            total_pages = 1
+        for task in tasks[max(total_pages - 1, 0):]:
+            task.cancel()
+        del tasks[max(total_pages - 1, 0):]
+        request_pages(range(len(tasks) + 2, total_pages + 1))
+        promises = tasks if ordered else asyncio.as_completed(tasks)
+        for promise in promises:
+            rsp = await promise
+            if records:
+                for obj in rsp["data"]:
+                    yield obj
+            else:
+                yield rsp["data"]
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()
 
 
 async def get_paginated(session, base_url, **kwargs):
@@ -86,45 +441,60 @@ async def get_paginated(session, base_url, **kwargs):
     Returns:
         the paginated data as JSON
     """
-    data = []
-    # perform the initial request
-    args = kwargs.copy()
-    args["per_page"] = RESULTS_PER_PAGE
-    req = await get_json(session, base_url, **args)
-    data.extend(req["data"])
-    # check if there are any further pages
-    next_page = req["meta"]["next_page"]
-    if not next_page:
-        return data
-    # perform requests for remaining pages concurrently
-    promises = []
-    for page in range(next_page, req["meta"]["total_pages"] + 1):
-        args["page"] = page
-        promises.append(get_json(session, base_url, **args))
-    # await all requests and combine results
-    responses = await asyncio.gather(*promises)
-    data.extend(
-        itertools.chain.from_iterable(rsp["data"] for rsp in responses))
-    return data
+    pages = iter_paginated(session, base_url, ordered=True, **kwargs)
+    return list(itertools.chain.from_iterable([page async for page in pages]))
 
 
-async def get_players(session, name=None):
+def iter_players(session, name=None, ordered=False):
     """
-    Retrieves information for all NBA players.
+    Retrieves information for all NBA players, yielding each player as soon as
+    its page is retrieved.
 
     Arguments:
         session : aiohttp.ClientSession object
         name    : Filter on the player first/last name
+        ordered : Yield players in page order, rather than in arrival order
 
     Returns:
-        a list of player info as JSON objects
+        an async iterator of player info as JSON objects
     """
     url = "/api/v1/players"
     args = {}
     if name:
         args["search"] = name
     # data is paginated
-    return await get_paginated(session, url, **args)
+    return iter_paginated(session, url, ordered=ordered, records=True, **args)
+
+
+async def get_players(session, name=None):
+    """
+    Retrieves information for all NBA players.
+
+    Arguments:
+        session : aiohttp.ClientSession object
+        name    : Filter on the player first/last name
+
+    Returns:
+        a list of player info as JSON objects
+    """
+    return [obj async for obj in iter_players(session, name, ordered=True)]
+
+
+def iter_all_teams(session, ordered=False):
+    """
+    Retrieves information for all NBA teams, yielding each team as soon as its
+    page is retrieved.
+
+    Arguments:
+        session : aiohttp.ClientSession object
+        ordered : Yield teams in page order, rather than in arrival order
+
+    Returns:
+        an async iterator of team info as JSON objects
+    """
+    url = "/api/v1/teams"
+    # data is paginated
+    return iter_paginated(session, url, ordered=ordered, records=True)
 
 
 async def get_all_teams(session):
@@ -137,27 +507,151 @@ async def get_all_teams(session):
     Returns:
         a list of team info as JSON objects
     """
-    url = "/api/v1/teams"
+    return [obj async for obj in iter_all_teams(session, ordered=True)]
+
+
+def iter_player_game_stats(
+    session, player_id, seasons, ordered=False, start_date=None,
+):
+    """
+    Retrieves game statistics for the given NBA player from the provided NBA
+    season(s), yielding each game as soon as its page is retrieved.
+
+    Arguments:
+        session    : aiohttp.ClientSession object
+        player_id  : Player ID
+        seasons    : NBA season(s) can be an int or a list
+        ordered    : Yield games in page order, rather than in arrival order
+        start_date : Only include games on or after the date (YYYY-MM-DD)
+
+    Returns:
+        an async iterator of player game stats as JSON objects
+    """
+    if not isinstance(seasons, collections.abc.Iterable):
+        seasons = [seasons]
+    url = "/api/v1/stats"
+    args = {"seasons": seasons, "player_ids": [player_id]}
+    if start_date:
+        args["start_date"] = start_date
     # data is paginated
-    return await get_paginated(session, url)
+    return iter_paginated(session, url, ordered=ordered, records=True, **args)
 
 
-async def get_player_game_stats(session, player_id, seasons):
+async def get_player_game_stats(
+    session, player_id, seasons, start_date=None,
+):
     """
     Retrieves game statistics for the given NBA player from the provided NBA
     season(s).
 
     Arguments:
-        session   : aiohttp.ClientSession object
-        player_id : Player ID
-        seasons   : NBA season(s) can be an int or a list
+        session    : aiohttp.ClientSession object
+        player_id  : Player ID
+        seasons    : NBA season(s) can be an int or a list
+        start_date : Only include games on or after the date (YYYY-MM-DD)
 
     Returns:
         the player averages as a JSON object
     """
+    stats = iter_player_game_stats(
+        session, player_id, seasons, ordered=True, start_date=start_date)
+    return [obj async for obj in stats]
+
+
+def encoded_length(url):
+    """
+    Gets the length of a URL as it is sent i.e. with "[]" percent-encoded.
+
+    Arguments:
+        url : URL string, relative to BASE_URL
+
+    Returns:
+        the length of the full, encoded URL
+    """
+    return len(str(yarl.URL(BASE_URL + url)))
+
+
+def pack_query_values(base_url, key, values, **kwargs):
+    """
+    Packs list parameter values into as few queries as the URL length limit
+    allows, leaving room for the pagination parameters. Lengths are measured
+    on the URLs as they are sent, after percent-encoding.
+
+    Arguments:
+        base_url : Base URL
+        key      : Name of the list query parameter to pack
+        values   : List of values for the parameter
+        kwargs   : Other query parameters, included in every query
+
+    Returns:
+        a list of lists of values, one per query
+    """
+    args = kwargs.copy()
+    args["per_page"] = RESULTS_PER_PAGE
+    args["page"] = 99999
+    base_len = encoded_length(build_url(base_url, **args))
+    chunks = []
+    chunk = []
+    length = base_len
+    for value in values:
+        # the "&" separator takes the place of the leading "?"
+        value_len = len(str(yarl.URL("?%s[]=%s" % (key, value))))
+        if chunk and length + value_len > MAX_URL_LENGTH:
+            chunks.append(chunk)
+            chunk = []
+            length = base_len
+        chunk.append(value)
+        length += value_len
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def split_by_season(stats):
+    """
+    Splits player game stats by season.
+
+    Arguments:
+        stats : List of player game stats as JSON objects
+
+    Returns:
+        a dict mapping each season to its player game stats JSON objects
+    """
+    seasons = collections.defaultdict(list)
+    for obj in stats:
+        seasons[obj["game"]["season"]].append(obj)
+    return dict(seasons)
+
+
+async def get_players_game_stats(session, player_ids, seasons):
+    """
+    Retrieves game statistics for many NBA players from the provided NBA
+    season(s). Players are batched into as few paginated queries as the URL
+    length limit allows.
+
+    Arguments:
+        session    : aiohttp.ClientSession object
+        player_ids : List of player IDs
+        seasons    : NBA season(s) can be an int or a list
+
+    Returns:
+        a dict mapping each player ID to a list of their game stats as JSON
+        objects
+    """
     if not isinstance(seasons, collections.abc.Iterable):
         seasons = [seasons]
+    seasons = list(seasons)
+    player_ids = list(dict.fromkeys(player_ids))
     url = "/api/v1/stats"
-    args = {"seasons": seasons, "player_ids": [player_id]}
-    # data is paginated
-    return await get_paginated(session, url, **args)
+    chunks = pack_query_values(url, "player_ids", player_ids, seasons=seasons)
+    responses = await asyncio.gather(*(
+        get_paginated(session, url, seasons=seasons, player_ids=chunk)
+        for chunk in chunks))
+    # split the results back out by player, skipping any players which were
+    # not requested
+    stats = {player_id: [] for player_id in player_ids}
+    for obj in itertools.chain.from_iterable(responses):
+        player_stats = stats.get((obj.get("player") or {}).get("id"))
+        if player_stats is not None:
+            player_stats.append(obj)
+    return stats
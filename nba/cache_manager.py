@@ -0,0 +1,352 @@
+# Copyright (C) 2022  Ian Brault
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from . import codec
+from . import log
+from . import storage
+from . import utils
+
+import time
+
+# maximum size of all the data stored in the local storage directory: the
+# database, the columnar files, the response cache, and the page counts, in
+# bytes
+MAX_SIZE = 256 * 1024 * 1024
+# time-to-live for each kind of stored data, in seconds, None never expires
+TTLS = {
+    "teams": 30 * 24 * 60 * 60,
+    "players": 7 * 24 * 60 * 60,
+    "historical": 90 * 24 * 60 * 60,
+    "current": 10 * 60,
+}
+KINDS = list(TTLS)
+# legacy per-file JSON caches, imported into the database by
+# storage.migrate_json
+LEGACY_PATTERNS = ["teams.json", "players.json", "player_*_games_*.json"]
+# page counts file, see storage.PageCounts
+PAGE_COUNTS = "pages.json"
+
+
+class CacheManager:
+    """
+    Manages the data stored in the local storage directory. Tracks whether
+    stored teams, players, and player seasons are still fresh, records hit
+    rates and player season accesses, and evicts the least-recently-used
+    cached responses and then player seasons once the local storage grows
+    past its maximum size. Complete
+    player seasons are optionally also stored in the columnar format, see
+    set_columnar.
+
+    Methods which access the database must be run on the database thread, see
+    Database.run.
+    """
+
+    def __init__(
+        self, database, directory, responses=None, max_size=None,
+        ttls=None,
+    ):
+        self.database = database
+        self.directory = directory
+        # optional ResponseCache object
+        self.responses = responses
+        # defaults to the size set by set_max_size, if any
+        if max_size is None:
+            stored = database.get_meta("max_size")
+            max_size = int(stored) if stored is not None else MAX_SIZE
+        self.max_size = max_size
+        # the response cache is also bounded by its own maximum size
+        if responses is not None:
+            self.responses_max_size = responses.max_size
+            responses.max_size = min(self.responses_max_size, max_size)
+        self.ttls = dict(TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        # hits/misses recorded by this process, by kind
+        self.hits = {kind: [0, 0] for kind in KINDS}
+        # player seasons accessed by this process, as (player ID, season)
+        self.accessed = set()
+        self.columnar = storage.ColumnarSeasons(directory / "columnar")
+        self.use_columnar = database.get_meta("columnar") == "1"
+
+    def ttl(self, kind):
+        return self.ttls.get(kind)
+
+    def is_fresh(self, kind, updated):
+        """
+        Checks if stored data is still fresh.
+
+        Arguments:
+            kind    : Kind of data, one of KINDS
+            updated : Time at which the data was stored, None if not stored
+
+        Returns:
+            True if the data is stored and has not expired
+        """
+        if updated is None:
+            return False
+        ttl = self.ttl(kind)
+        return ttl is None or time.time() - updated < ttl
+
+    def record(self, kind, hit):
+        """
+        Records a lookup of stored data.
+
+        Arguments:
+            kind : Kind of data, one of KINDS
+            hit  : True if the stored data was used
+        """
+        self.hits[kind][0 if hit else 1] += 1
+
+    def access(self, player_id, season):
+        """
+        Records an access of a stored player season, for eviction.
+        """
+        self.accessed.add((player_id, season))
+
+    def set_max_size(self, max_size):
+        """
+        Sets the maximum size of the local storage, for this and later runs.
+
+        Arguments:
+            max_size : Maximum size in bytes
+        """
+        self.database.set_meta("max_size", str(max_size))
+        self.max_size = max_size
+        if self.responses is not None:
+            self.responses.max_size = min(self.responses_max_size, max_size)
+
+    def set_columnar(self, enabled):
+        """
+        Enables/disables storing complete player seasons in the columnar
+        format. Seasons are written the next time they are loaded, and the
+        files are removed when disabled.
+        """
+        self.database.set_meta("columnar", "1" if enabled else "0")
+        self.use_columnar = enabled
+        if not enabled:
+            self.columnar.clear()
+
+    def load_player_game_stats(self, player_id, season):
+        """
+        Loads the stored game statistics for the given player and season, and
+        records the access. Complete seasons are read from the columnar files
+        when enabled, and written to them on first load.
+
+        Arguments:
+            player_id : Player ID
+            season    : NBA season
+
+        Returns:
+            a list of player game stats as JSON objects, or None if the season
+            has not been stored for the player
+        """
+        self.access(player_id, season)
+        if not self.use_columnar or not self.database.has_player_game_stats(
+                player_id, season, complete=True):
+            return self.database.load_player_game_stats(player_id, season)
+        stats = self.columnar.load(player_id, season)
+        if stats is None:
+            stats = self.database.load_player_game_stats(player_id, season)
+            self.columnar.store(player_id, season, stats)
+        return stats
+
+    def store_player_game_stats(self, player_id, season, stats, complete):
+        """
+        Stores the game statistics for the given player and season, see
+        Database.store_player_game_stats, replacing any columnar copy.
+        """
+        self.columnar.delete([(player_id, season)])
+        self.database.store_player_game_stats(
+            player_id, season, stats, complete)
+
+    def delete_player_seasons(self, keys):
+        self.columnar.delete(keys)
+        self.database.delete_player_seasons(keys)
+
+    def load_hits(self):
+        """
+        Loads the hits/misses recorded by all runs, including this one.
+
+        Returns:
+            a dict mapping each kind to a list of hits and misses
+        """
+        hits = {kind: [0, 0] for kind in KINDS}
+        stored = self.database.get_meta("cache_hits")
+        if stored is not None:
+            for kind, counts in codec.loads(stored).items():
+                if kind in hits:
+                    hits[kind] = list(counts)
+        for kind, (nhits, nmisses) in self.hits.items():
+            hits[kind][0] += nhits
+            hits[kind][1] += nmisses
+        return hits
+
+    def flush(self):
+        """
+        Stores the hits/misses and accesses recorded by this process, and
+        evicts cached responses and player seasons if the local storage is
+        over its maximum size.
+        """
+        if any(nhits or nmisses for nhits, nmisses in self.hits.values()):
+            hits = self.load_hits()
+            self.database.set_meta(
+                "cache_hits", codec.dumps(hits).decode("utf-8"))
+            self.hits = {kind: [0, 0] for kind in KINDS}
+        if self.accessed:
+            self.database.touch_player_seasons(
+                sorted(self.accessed), time.time())
+            self.accessed = set()
+        if self.storage_size() > self.max_size:
+            self.evict()
+
+    def storage_size(self):
+        """
+        Measures the size of all the data stored in the local storage
+        directory, which is bounded by the maximum size.
+
+        Returns:
+            the size in bytes
+        """
+        size = self.database.size() + self.columnar.disk_usage()
+        if self.responses is not None:
+            self.responses.size = self.responses.disk_usage()
+            size += self.responses.size
+        path = self.directory / PAGE_COUNTS
+        if path.exists():
+            size += path.stat().st_size
+        return size
+
+    def evict(self, target=None):
+        """
+        Removes the least-recently-used cached responses and then player
+        seasons until the local storage is below the target size, by default
+        leaving some headroom below the maximum size to avoid evicting on
+        every run. Cached responses go first, as the player seasons are
+        slower to fetch again.
+
+        Arguments:
+            target : Target size in bytes
+
+        Returns:
+            the number of player seasons removed
+        """
+        if target is None:
+            target = self.max_size * 0.9
+        excess = self.storage_size() - target
+        if excess <= 0:
+            return 0
+        if self.responses is not None:
+            excess -= self.responses.evict(
+                target=max(self.responses.size - excess, 0))
+            if excess <= 0:
+                return 0
+        seasons = self.database.list_player_seasons()
+        # deleted rows only free their pages once they are reused/vacuumed, so
+        # estimate the space freed from the average size of a stored game
+        ngames = sum(row["games"] for row in seasons)
+        game_size = self.database.size() / max(ngames, 1)
+        keys = []
+        for row in seasons:
+            if excess <= 0:
+                break
+            keys.append((row["player_id"], row["season"]))
+            excess -= row["games"] * game_size
+            path = self.columnar.path(row["player_id"], row["season"])
+            if path.exists():
+                excess -= path.stat().st_size
+        self.delete_player_seasons(keys)
+        log.debug("evicted %u player seasons" % len(keys))
+        return len(keys)
+
+    def expired_player_seasons(self):
+        """
+        Finds the previous player seasons which have expired. Seasons which
+        have not ended are synced incrementally and never expire.
+
+        Returns:
+            a list of (player ID, season) tuples
+        """
+        return [
+            (row["player_id"], row["season"])
+            for row in self.database.list_player_seasons()
+            if utils.is_season_over(row["season"])
+            and not self.is_fresh("historical", row["updated"])]
+
+    def compact(self):
+        """
+        Removes expired player seasons, evicts cached responses and player
+        seasons until the local storage is below its maximum size, removes
+        the legacy JSON files once they have been imported, and rebuilds the
+        database file.
+
+        Returns:
+            a dict with the number of expired and evicted player seasons and
+            the number of legacy files removed
+        """
+        expired = self.expired_player_seasons()
+        self.delete_player_seasons(expired)
+        evicted = self.evict()
+        removed = 0
+        if self.database.get_meta("json_migrated") is not None:
+            for pattern in LEGACY_PATTERNS:
+                for path in self.directory.glob(pattern):
+                    try:
+                        path.unlink()
+                        removed += 1
+                    except (IOError, OSError) as ex:
+                        log.error("failed to remove %s: %s" % (path, ex))
+        if self.responses is not None:
+            self.responses.size = self.responses.disk_usage()
+            if self.responses.size > self.responses.max_size:
+                self.responses.evict()
+        self.database.vacuum()
+        return {
+            "expired": len(expired),
+            "evicted": evicted,
+            "removed": removed,
+        }
+
+    def usage(self):
+        """
+        Reports the local storage usage.
+
+        Returns:
+            a dict with the total and maximum sizes, the database size and
+            record counts, the columnar and response cache sizes and file
+            counts, the page counts size, and the hits/misses by kind
+        """
+        usage = {
+            "total": self.storage_size(),
+            "database": self.database.size(),
+            "max_size": self.max_size,
+            "teams": self.database.count("teams"),
+            "players": self.database.count("players"),
+            "player_seasons": self.database.count("player_seasons"),
+            "games": self.database.count("stats"),
+            "columnar": self.columnar.disk_usage(),
+            "columnar_files": len(self.columnar.files()),
+            "responses": 0,
+            "response_files": 0,
+            "pages": 0,
+            "hits": self.load_hits(),
+        }
+        if self.responses is not None and self.responses.directory.exists():
+            usage["responses"] = self.responses.disk_usage()
+            usage["response_files"] = len(
+                list(self.responses.directory.glob("*.json")))
+        path = self.directory / PAGE_COUNTS
+        if path.exists():
+            usage["pages"] = path.stat().st_size
+        return usage
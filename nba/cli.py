@@ -77,4 +77,17 @@ def parse_args(args):
         "-o", dest="opponent", metavar="TEAM",
         help="Opponent")
 
+    cache_subparser = add_subparser(
+        subparsers, "cache",
+        description="Reports local storage usage and hit rates.")
+    cache_subparser.add_argument(
+        "-c", "--compact", action="store_true",
+        help="Remove expired and least-recently-used data")
+    cache_subparser.add_argument(
+        "-s", dest="max_size", metavar="MB", type=int,
+        help="Maximum local storage size")
+    cache_subparser.add_argument(
+        "--columnar", choices=["on", "off"],
+        help="Also store complete seasons in the binary columnar format")
+
     return parser.parse_args(args)
@@ -0,0 +1,106 @@
+# Copyright (C) 2022  Ian Brault
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import importlib
+
+
+def _orjson_codec(module):
+    return module.loads, module.dumps
+
+
+def _ujson_codec(module):
+    def dumps(obj):
+        return module.dumps(obj, ensure_ascii=False).encode("utf-8")
+    return module.loads, dumps
+
+
+def _json_codec(module):
+    def dumps(obj):
+        return module.dumps(
+            obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return module.loads, dumps
+
+
+# JSON backends in order of preference, orjson/ujson are used when installed
+# and the standard library json module is the fallback
+BACKENDS = {
+    "orjson": _orjson_codec,
+    "ujson": _ujson_codec,
+    "json": _json_codec,
+}
+
+
+def available_backends():
+    """
+    Lists the backends which are installed, in order of preference.
+
+    Returns:
+        a list of backend names
+    """
+    backends = []
+    for name in BACKENDS:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            continue
+        backends.append(name)
+    return backends
+
+
+def set_backend(name):
+    """
+    Selects the backend used by loads/dumps.
+
+    Arguments:
+        name : Backend name, one of BACKENDS
+    """
+    global backend, _loads, _dumps
+    _loads, _dumps = BACKENDS[name](importlib.import_module(name))
+    backend = name
+
+
+def loads(data):
+    """
+    Decodes JSON data.
+
+    Arguments:
+        data : JSON document as bytes or str, bytes are decoded directly
+               without an intermediate str copy
+
+    Returns:
+        the decoded object
+
+    Raises:
+        ValueError if the data is not valid JSON
+    """
+    return _loads(data)
+
+
+def dumps(obj):
+    """
+    Encodes an object as compact UTF-8 JSON.
+
+    Arguments:
+        obj : Object to encode
+
+    Returns:
+        the JSON document as bytes
+    """
+    return _dumps(obj)
+
+
+# name of the selected backend
+backend = None
+set_backend(available_backends()[0])
@@ -0,0 +1,276 @@
+# Copyright (C) 2022  Ian Brault
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from . import codec
+
+import array
+import math
+import struct
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# file layout:
+#   magic (4 bytes) | version (u16) | reserved (u16) | row count (u32) |
+#   header length (u32) | header (JSON) | columns
+# the header describes each column and holds the shared game/team/player
+# tables and the string table, each column is a fixed-width little-endian
+# array aligned to 8 bytes
+MAGIC = b"NBAC"
+VERSION = 1
+PREAMBLE = struct.Struct("<4sHHII")
+ALIGNMENT = 8
+
+STAT_FIELDS = [
+    "ast", "blk", "dreb", "fg3_pct", "fg3a", "fg3m", "fg_pct", "fga", "fgm",
+    "ft_pct", "fta", "ftm", "oreb", "pf", "pts", "reb", "stl", "turnover",
+]
+# columns holding references into the shared tables
+TABLE_FIELDS = ["game", "team", "player"]
+# columns holding references into the string table
+STRING_FIELDS = ["min"]
+
+# array typecodes for each column type, and the value used to encode nulls
+TYPECODES = {"i4": "i", "i8": "q", "f8": "d"}
+NULLS = {"i4": -2 ** 31, "i8": -2 ** 63, "f8": None}
+
+
+class FormatError(ValueError):
+    """
+    Raised when columnar data is malformed.
+    """
+    pass
+
+
+def _column_type(values):
+    if all(v is None or (isinstance(v, int) and not isinstance(v, bool))
+           for v in values):
+        ints = [v for v in values if v is not None]
+        if all(NULLS["i4"] < v < 2 ** 31 for v in ints):
+            return "i4"
+        return "i8"
+    return "f8"
+
+
+def _pack(values, kind):
+    null = NULLS[kind]
+    if kind == "f8":
+        values = [math.nan if v is None else float(v) for v in values]
+    else:
+        values = [null if v is None else v for v in values]
+    arr = array.array(TYPECODES[kind], values)
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def encode(stats):
+    """
+    Encodes player game stats in the columnar format.
+
+    Arguments:
+        stats : List of player game stats as JSON objects
+
+    Returns:
+        the encoded data as bytes
+    """
+    nrows = len(stats)
+    tables = {field: [] for field in TABLE_FIELDS}
+    refs = {field: {} for field in TABLE_FIELDS}
+    strings = []
+    string_refs = {}
+    columns = {"id": [obj.get("id") for obj in stats]}
+    for field in STAT_FIELDS:
+        columns[field] = [obj.get(field) for obj in stats]
+    # games/teams/players are stored once and referenced by index
+    for field in TABLE_FIELDS:
+        column = []
+        for obj in stats:
+            value = obj.get(field)
+            if value is None:
+                column.append(None)
+                continue
+            key = codec.dumps(value)
+            if key not in refs[field]:
+                refs[field][key] = len(tables[field])
+                tables[field].append(value)
+            column.append(refs[field][key])
+        columns[field] = column
+    for field in STRING_FIELDS:
+        column = []
+        for obj in stats:
+            value = obj.get(field)
+            if value is not None and not isinstance(value, str):
+                # keep non-string values (i.e. numeric minutes) as JSON
+                value = codec.dumps(value).decode("utf-8")
+                value = "\0" + value
+            if value is None:
+                column.append(None)
+                continue
+            if value not in string_refs:
+                string_refs[value] = len(strings)
+                strings.append(value)
+            column.append(string_refs[value])
+        columns[field] = column
+
+    header = {"columns": [], "strings": strings}
+    header.update(tables)
+    blobs = []
+    offset = 0
+    for name, values in columns.items():
+        kind = _column_type(values)
+        blob = _pack(values, kind)
+        header["columns"].append(
+            {"name": name, "type": kind, "offset": offset})
+        blobs.append(blob)
+        offset += len(blob)
+        padding = -offset % ALIGNMENT
+        blobs.append(b"\0" * padding)
+        offset += padding
+    header_bytes = codec.dumps(header)
+    # align the column data relative to the start of the file
+    data_start = PREAMBLE.size + len(header_bytes)
+    header_bytes += b" " * (-data_start % ALIGNMENT)
+    preamble = PREAMBLE.pack(MAGIC, VERSION, 0, nrows, len(header_bytes))
+    return b"".join([preamble, header_bytes] + blobs)
+
+
+class ColumnarStats:
+    """
+    Player game stats decoded from the columnar format. Columns are views into
+    the underlying buffer, no per-row objects are constructed until rows are
+    converted back to JSON.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer)
+        if len(self.buffer) < PREAMBLE.size:
+            raise FormatError("truncated columnar data")
+        magic, version, _, nrows, header_len = PREAMBLE.unpack_from(
+            self.buffer)
+        if magic != MAGIC:
+            raise FormatError("not columnar data")
+        if version != VERSION:
+            raise FormatError("unsupported columnar version %u" % version)
+        self.nrows = nrows
+        header_end = PREAMBLE.size + header_len
+        if len(self.buffer) < header_end:
+            raise FormatError("truncated columnar data")
+        try:
+            header = codec.loads(bytes(self.buffer[PREAMBLE.size:header_end]))
+        except ValueError as ex:
+            raise FormatError("invalid columnar header: %s" % ex)
+        self.strings = header["strings"]
+        self.tables = {field: header[field] for field in TABLE_FIELDS}
+        self.types = {}
+        self.offsets = {}
+        for column in header["columns"]:
+            self.types[column["name"]] = column["type"]
+            self.offsets[column["name"]] = header_end + column["offset"]
+        size = max(
+            (self.offsets[name] + self.itemsize(name) * nrows
+             for name in self.offsets), default=header_end)
+        if len(self.buffer) < size:
+            raise FormatError("truncated columnar data")
+
+    def __len__(self):
+        return self.nrows
+
+    @property
+    def names(self):
+        return list(self.types)
+
+    def itemsize(self, name):
+        return 4 if self.types[name] == "i4" else 8
+
+    def column(self, name):
+        """
+        Gets the raw values for a column, as a numpy array if numpy is
+        available and otherwise as a memoryview. Nulls are encoded as NaN for
+        floating-point columns and as the NULLS sentinel for integer columns,
+        and table/string columns hold indexes into their tables.
+
+        Arguments:
+            name : Column name
+
+        Returns:
+            the column array
+        """
+        kind = self.types[name]
+        offset = self.offsets[name]
+        if numpy is not None:
+            return numpy.frombuffer(
+                self.buffer, dtype="<" + kind, count=self.nrows,
+                offset=offset)
+        view = self.buffer[offset:offset + self.itemsize(name) * self.nrows]
+        if sys.byteorder != "little":
+            arr = array.array(TYPECODES[kind], view.tobytes())
+            arr.byteswap()
+            return memoryview(arr)
+        return view.cast(TYPECODES[kind])
+
+    def values(self, name):
+        """
+        Gets the values for a column as a list, with nulls as None.
+        """
+        kind = self.types[name]
+        values = self.column(name).tolist()
+        if kind == "f8":
+            return [None if math.isnan(v) else v for v in values]
+        null = NULLS[kind]
+        return [None if v == null else v for v in values]
+
+    def toJSON(self):
+        """
+        Converts the stats back to their JSON form.
+
+        Returns:
+            a list of player game stats as JSON objects
+        """
+        rows = [{} for _ in range(self.nrows)]
+        for name in self.names:
+            values = self.values(name)
+            if name in TABLE_FIELDS:
+                table = self.tables[name]
+                values = [None if v is None else table[v] for v in values]
+            elif name in STRING_FIELDS:
+                values = [
+                    None if v is None else self._string(v) for v in values]
+            for row, value in zip(rows, values):
+                if value is not None or name not in TABLE_FIELDS:
+                    row[name] = value
+        return rows
+
+    def _string(self, ref):
+        value = self.strings[ref]
+        if value.startswith("\0"):
+            return codec.loads(value[1:])
+        return value
+
+
+def decode(data):
+    """
+    Decodes player game stats from the columnar format.
+
+    Arguments:
+        data : Encoded data, as bytes or any buffer i.e. an mmap
+
+    Returns:
+        the ColumnarStats object
+    """
+    return ColumnarStats(data)
@@ -0,0 +1,174 @@
+# Copyright (C) 2022  Ian Brault
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import importlib
+import struct
+import zlib
+
+# file layout:
+#   magic (4 bytes) | version (u16) | method (u16) | payload length (u32) |
+#   data length (u32) | data CRC-32 (u32) | payload
+# the payload is the data compressed with the given method, the lengths and
+# checksum are used to detect truncated or corrupt files
+MAGIC = b"NBAZ"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIII")
+
+
+class FormatError(ValueError):
+    """
+    Raised when framed data is truncated or corrupt.
+    """
+    pass
+
+
+def _none_method(module):
+    return bytes, lambda payload, size: bytes(payload)
+
+
+def _gzip_method(module):
+    def compress(data):
+        # fixed mtime so that identical data produces identical files
+        return module.compress(data, compresslevel=6, mtime=0)
+
+    def decompress(payload, size):
+        try:
+            return module.decompress(payload)
+        except (OSError, EOFError, zlib.error) as ex:
+            raise FormatError("failed to decompress data: %s" % ex)
+    return compress, decompress
+
+
+def _zstd_method(module):
+    compressor = module.ZstdCompressor(level=3)
+    decompressor = module.ZstdDecompressor()
+
+    def decompress(payload, size):
+        try:
+            return decompressor.decompress(payload, max_output_size=size)
+        except module.ZstdError as ex:
+            raise FormatError("failed to decompress data: %s" % ex)
+    return compressor.compress, decompress
+
+
+# compression methods in order of preference, by name: the module providing
+# the method, the method ID stored in the header, and the method factory, zstd
+# is used when installed and gzip is the fallback
+METHODS = {
+    "zstd": ("zstandard", 2, _zstd_method),
+    "gzip": ("gzip", 1, _gzip_method),
+    # stored uncompressed, only checksummed
+    "none": ("zlib", 0, _none_method),
+}
+_method_names = {
+    method_id: name for name, (_, method_id, _) in METHODS.items()}
+# loaded methods, by name
+_methods = {}
+
+
+def available_methods():
+    """
+    Lists the compression methods which are installed, in order of
+    preference.
+
+    Returns:
+        a list of method names
+    """
+    methods = []
+    for name, (module, _, _) in METHODS.items():
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            continue
+        methods.append(name)
+    return methods
+
+
+def _get_method(name):
+    if name not in _methods:
+        module, _, factory = METHODS[name]
+        _methods[name] = factory(importlib.import_module(module))
+    return _methods[name]
+
+
+def frame(data, method=None):
+    """
+    Compresses data and prepends the header.
+
+    Arguments:
+        data   : Data as bytes
+        method : Compression method, one of METHODS, defaults to the preferred
+                 installed method
+
+    Returns:
+        the framed data as bytes
+    """
+    if method is None:
+        method = default_method
+    compress, _ = _get_method(method)
+    payload = compress(data)
+    header = HEADER.pack(
+        MAGIC, VERSION, METHODS[method][1], len(payload), len(data),
+        zlib.crc32(data))
+    return header + payload
+
+
+def is_framed(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+def unframe(data):
+    """
+    Verifies and decompresses framed data. Data without the header is assumed
+    to be stored uncompressed, as written by earlier versions, and is returned
+    unmodified.
+
+    Arguments:
+        data : Framed data as bytes
+
+    Returns:
+        the decompressed data as bytes
+
+    Raises:
+        FormatError if the data is truncated or corrupt
+    """
+    if not is_framed(data):
+        return data
+    if len(data) < HEADER.size:
+        raise FormatError("truncated header")
+    _, version, method_id, payload_len, data_len, crc = HEADER.unpack_from(
+        data)
+    if version != VERSION:
+        raise FormatError("unsupported version %u" % version)
+    name = _method_names.get(method_id)
+    if name is None:
+        raise FormatError("unknown compression method %u" % method_id)
+    payload = data[HEADER.size:]
+    if len(payload) != payload_len:
+        raise FormatError(
+            "expected %u bytes of data, found %u"
+            % (payload_len, len(payload)))
+    try:
+        _, decompress = _get_method(name)
+    except ImportError:
+        raise FormatError("compression method %s is not installed" % name)
+    result = decompress(payload, data_len)
+    if len(result) != data_len or zlib.crc32(result) != crc:
+        raise FormatError("checksum mismatch")
+    return result
+
+
+# name of the preferred installed method
+default_method = available_methods()[0]
@@ -0,0 +1,760 @@
+# Copyright (C) 2022  Ian Brault
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from . import log
+from . import search
+from . import stats_table
+
+import asyncio
+import concurrent.futures
+import functools
+import sqlite3
+import time
+
+TEAM_FIELDS = [
+    "id", "abbreviation", "city", "conference", "division", "full_name",
+    "name",
+]
+PLAYER_FIELDS = ["id", "first_name", "last_name", "position", "team_id"]
+GAME_FIELDS = [
+    "id", "date", "season", "home_team_id", "home_team_score",
+    "visitor_team_id", "visitor_team_score",
+]
+STAT_FIELDS = [
+    "ast", "blk", "dreb", "fg3_pct", "fg3a", "fg3m", "fg_pct", "fga", "fgm",
+    "ft_pct", "fta", "ftm", "min", "oreb", "pf", "pts", "reb", "stl",
+    "turnover",
+]
+# summed counting stats stored in the materialized player season aggregates
+AGGREGATE_FIELDS = stats_table.STAT_FIELDS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS teams (
+    id INTEGER PRIMARY KEY,
+    abbreviation TEXT,
+    city TEXT,
+    conference TEXT,
+    division TEXT,
+    full_name TEXT,
+    name TEXT
+);
+CREATE TABLE IF NOT EXISTS players (
+    id INTEGER PRIMARY KEY,
+    first_name TEXT,
+    last_name TEXT,
+    position TEXT,
+    team_id INTEGER REFERENCES teams (id),
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS games (
+    id INTEGER PRIMARY KEY,
+    date TEXT,
+    season INTEGER,
+    home_team_id INTEGER REFERENCES teams (id),
+    home_team_score INTEGER,
+    visitor_team_id INTEGER REFERENCES teams (id),
+    visitor_team_score INTEGER
+);
+CREATE TABLE IF NOT EXISTS stats (
+    id INTEGER PRIMARY KEY,
+    player_id INTEGER NOT NULL REFERENCES players (id),
+    game_id INTEGER NOT NULL REFERENCES games (id),
+    team_id INTEGER REFERENCES teams (id),
+    opponent_id INTEGER REFERENCES teams (id),
+    season INTEGER NOT NULL,
+    ast INTEGER,
+    blk INTEGER,
+    dreb INTEGER,
+    fg3_pct REAL,
+    fg3a INTEGER,
+    fg3m INTEGER,
+    fg_pct REAL,
+    fga INTEGER,
+    fgm INTEGER,
+    ft_pct REAL,
+    fta INTEGER,
+    ftm INTEGER,
+    min TEXT,
+    oreb INTEGER,
+    pf INTEGER,
+    pts INTEGER,
+    reb INTEGER,
+    stl INTEGER,
+    turnover INTEGER
+);
+-- player seasons which have been stored, including seasons without games,
+-- complete once the whole season has been stored after it ended
+CREATE TABLE IF NOT EXISTS player_seasons (
+    player_id INTEGER NOT NULL,
+    season INTEGER NOT NULL,
+    updated REAL,
+    accessed REAL,
+    complete INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (player_id, season)
+);
+-- materialized totals of the games played in each stored player season,
+-- removed whenever the season's games change
+CREATE TABLE IF NOT EXISTS player_season_aggregates (
+    player_id INTEGER NOT NULL,
+    season INTEGER NOT NULL,
+    games INTEGER NOT NULL,
+    dnp INTEGER NOT NULL,
+    %s,
+    PRIMARY KEY (player_id, season)
+);
+-- trigrams of player names, for fuzzy search
+CREATE TABLE IF NOT EXISTS player_trigrams (
+    trigram TEXT NOT NULL,
+    player_id INTEGER NOT NULL,
+    PRIMARY KEY (trigram, player_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS players_first_name
+    ON players (first_name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS players_last_name
+    ON players (last_name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS games_date ON games (date);
+CREATE INDEX IF NOT EXISTS games_season ON games (season);
+CREATE INDEX IF NOT EXISTS stats_player_season ON stats (player_id, season);
+CREATE INDEX IF NOT EXISTS stats_season ON stats (season);
+CREATE INDEX IF NOT EXISTS stats_game ON stats (game_id);
+CREATE INDEX IF NOT EXISTS stats_opponent ON stats (opponent_id);
+""" % ",\n    ".join("%s REAL" % field for field in AGGREGATE_FIELDS)
+# columns added since the tables were first created, added to existing
+# databases when they are opened
+ADDED_COLUMNS = [
+    ("players", "updated", "REAL"),
+    ("player_seasons", "accessed", "REAL"),
+    ("player_seasons", "complete", "INTEGER NOT NULL DEFAULT 0"),
+]
+
+
+def columns(fields, prefix=""):
+    return ", ".join("%s%s" % (prefix, field) for field in fields)
+
+
+def placeholders(fields):
+    return ", ".join("?" for _ in fields)
+
+
+class Database:
+    """
+    SQLite-backed local store for NBA players, teams, games, and player game
+    statistics. Records are passed in and out in the same JSON shape that the
+    API provides.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        log.debug("opening database %s" % path)
+        # the connection is created here but used from the database thread,
+        # see run()
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        # write-ahead logging allows readers to proceed alongside a writer
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self._add_columns()
+        self.executor = None
+
+    def _add_columns(self):
+        for table, column, decl in ADDED_COLUMNS:
+            rows = self.conn.execute("PRAGMA table_info(%s)" % table)
+            if column not in [row["name"] for row in rows]:
+                with self.conn:
+                    self.conn.execute(
+                        "ALTER TABLE %s ADD COLUMN %s %s"
+                        % (table, column, decl))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.conn.close()
+
+    async def run(self, func, *args):
+        """
+        Runs a function which accesses the database on the database thread, so
+        that queries and any decoding done by the function do not block the
+        event loop. Functions are run one at a time, in the order they are
+        submitted. Once run() has been used, all database access should go
+        through it.
+
+        Arguments:
+            func : Function to run i.e. a Database method
+            args : Function arguments
+
+        Returns:
+            the value returned by the function
+        """
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="nba-database")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(func, *args))
+
+    def get_meta(self, key):
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else None
+
+    def set_meta(self, key, value):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (key, value))
+
+    def _upsert(self, table, fields, values):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO %s (%s) VALUES (%s)"
+            % (table, columns(fields), placeholders(fields)), values)
+
+    def _upsert_team(self, team):
+        # teams embedded in player/stats records may be partial, do not
+        # overwrite a full record with a partial one
+        if not team or team.get("id") is None:
+            return
+        values = [team.get(field) for field in TEAM_FIELDS]
+        if all(value is not None for value in values):
+            self._upsert("teams", TEAM_FIELDS, values)
+        else:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO teams (id) VALUES (?)", (team["id"],))
+
+    @staticmethod
+    def _team_json(row, prefix="team_"):
+        if row[prefix + "id"] is None:
+            return None
+        return {field: row[prefix + field] for field in TEAM_FIELDS}
+
+    def load_teams(self):
+        """
+        Loads all teams.
+
+        Returns:
+            a list of team info as JSON objects
+        """
+        rows = self.conn.execute(
+            "SELECT %s FROM teams WHERE abbreviation IS NOT NULL ORDER BY id"
+            % columns(TEAM_FIELDS))
+        return [dict(row) for row in rows]
+
+    def store_teams(self, teams):
+        """
+        Stores the given teams.
+
+        Arguments:
+            teams : List of team info as JSON objects
+        """
+        with self.conn:
+            for team in teams:
+                self._upsert_team(team)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                ("teams_updated", str(time.time())))
+
+    def get_teams_updated(self):
+        """
+        Gets the time at which the teams were last stored.
+
+        Returns:
+            the time as a UNIX timestamp, or None if no teams are stored
+        """
+        value = self.get_meta("teams_updated")
+        return float(value) if value is not None else None
+
+    def _player_query(self, where=""):
+        return (
+            "SELECT %s, %s FROM players p"
+            " LEFT JOIN teams t ON t.id = p.team_id %s ORDER BY p.id"
+            % (columns(PLAYER_FIELDS[:-1], "p."),
+               ", ".join("t.%s AS team_%s" % (f, f) for f in TEAM_FIELDS),
+               where))
+
+    def _player_json(self, row):
+        player = {field: row[field] for field in PLAYER_FIELDS[:-1]}
+        player["team"] = self._team_json(row)
+        return player
+
+    def load_players(self):
+        """
+        Loads all players.
+
+        Returns:
+            a list of player info as JSON objects
+        """
+        rows = self.conn.execute(self._player_query())
+        return [self._player_json(row) for row in rows]
+
+    def find_players(self, names, max_age=None):
+        """
+        Finds players by first/last name(s), using the same matching rules as
+        NBAState.filter_players. Lookups use the name indexes so that only the
+        matching players are read.
+
+        Arguments:
+            names   : First/last name(s) to filter on, can be a single string
+                      or a list of 1 or 2 strings
+            max_age : Only include players stored within this many seconds
+
+        Returns:
+            a list of matching player info as JSON objects
+        """
+        if isinstance(names, str):
+            names = [names]
+        names = list(names)
+        if len(names) > 1:
+            where = (
+                "WHERE p.first_name = ? COLLATE NOCASE"
+                " AND p.last_name = ? COLLATE NOCASE")
+            args = (names[0], " ".join(names[1:]))
+        else:
+            where = (
+                "WHERE p.first_name = ? COLLATE NOCASE"
+                " OR p.last_name = ? COLLATE NOCASE")
+            args = (names[0], names[0])
+        if max_age is not None:
+            where = "WHERE (%s) AND p.updated >= ?" % where[len("WHERE "):]
+            args += (time.time() - max_age,)
+        rows = self.conn.execute(self._player_query(where), args)
+        return [self._player_json(row) for row in rows]
+
+    def store_players(self, players):
+        """
+        Stores the given players.
+
+        Arguments:
+            players : List of player info as JSON objects
+        """
+        now = time.time()
+        with self.conn:
+            for player in players:
+                team = player.get("team")
+                self._upsert_team(team)
+                values = [player.get(field) for field in PLAYER_FIELDS[:-1]]
+                values.append(team.get("id") if team else None)
+                values.append(now)
+                self._upsert("players", PLAYER_FIELDS + ["updated"], values)
+                self._index_player_trigrams(player)
+
+    def _index_player_trigrams(self, player):
+        self.conn.execute(
+            "DELETE FROM player_trigrams WHERE player_id = ?", (player["id"],))
+        self.conn.executemany(
+            "INSERT INTO player_trigrams (trigram, player_id) VALUES (?, ?)",
+            [(gram, player["id"]) for gram in search.player_trigrams(player)])
+
+    def _build_player_trigrams(self):
+        # players stored before the trigram index existed are indexed once
+        log.debug("building player search index")
+        with self.conn:
+            for player in self.load_players():
+                self._index_player_trigrams(player)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                ("player_trigrams", str(time.time())))
+
+    def search_players(self, query, max_age=None, limit=10):
+        """
+        Searches for players by name, tolerating typos and accent variants.
+        Candidates sharing enough name trigrams with the query are read using
+        the trigram index and then ranked.
+
+        Arguments:
+            query   : Search query string i.e. a partial/misspelled name
+            max_age : Only include players stored within this many seconds
+            limit   : Maximum number of results
+
+        Returns:
+            a list of (score, player info JSON object) tuples, best match
+            first, see search.rank
+        """
+        if self.get_meta("player_trigrams") is None:
+            self._build_player_trigrams()
+        grams = sorted(search.trigrams(query))
+        if not grams:
+            return []
+        # a player can only reach the threshold if it shares at least this
+        # many trigrams with the query
+        min_shared = max(1, int(search.THRESHOLD * len(grams) / 2))
+        # stale players are filtered out before the candidates are limited
+        where = "WHERE pt.trigram IN (%s)" % placeholders(grams)
+        args = list(grams)
+        if max_age is not None:
+            where += " AND p.updated >= ?"
+            args.append(time.time() - max_age)
+        rows = self.conn.execute(
+            "SELECT pt.player_id FROM player_trigrams pt"
+            " JOIN players p ON p.id = pt.player_id %s"
+            " GROUP BY pt.player_id HAVING COUNT(*) >= ?"
+            " ORDER BY COUNT(*) DESC LIMIT ?"
+            % where, args + [min_shared, limit * 2])
+        player_ids = [row["player_id"] for row in rows]
+        if not player_ids:
+            return []
+        rows = self.conn.execute(
+            self._player_query(
+                "WHERE p.id IN (%s)" % placeholders(player_ids)),
+            player_ids)
+        players = [self._player_json(row) for row in rows]
+        return search.rank(query, players)[:limit]
+
+    def touch_players(self, player_ids):
+        """
+        Marks the given players as up-to-date, without modifying them.
+
+        Arguments:
+            player_ids : List of player IDs
+        """
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE players SET updated = ? WHERE id = ?",
+                [(now, player_id) for player_id in player_ids])
+
+    def has_player_game_stats(
+        self, player_id, season, max_age=None, complete=False,
+    ):
+        """
+        Checks if the game statistics for the given player and season are
+        stored.
+
+        Arguments:
+            player_id : Player ID
+            season    : NBA season
+            max_age   : Only include statistics stored within this many
+                        seconds
+            complete  : Only include seasons which were stored in full after
+                        they ended, see store_player_game_stats
+
+        Returns:
+            True if the statistics are stored
+        """
+        row = self.conn.execute(
+            "SELECT updated, complete FROM player_seasons"
+            " WHERE player_id = ? AND season = ?",
+            (player_id, season)).fetchone()
+        if row is None:
+            return False
+        if complete and not row["complete"]:
+            return False
+        if max_age is None:
+            return True
+        return (
+            row["updated"] is not None
+            and row["updated"] >= time.time() - max_age)
+
+    def refresh_player_season(self, player_id, season):
+        """
+        Marks the stored game statistics for the given player and season as
+        up-to-date, without modifying them.
+
+        Arguments:
+            player_id : Player ID
+            season    : NBA season
+        """
+        with self.conn:
+            self.conn.execute(
+                "UPDATE player_seasons SET updated = ?"
+                " WHERE player_id = ? AND season = ?",
+                (time.time(), player_id, season))
+
+    def touch_player_seasons(self, keys, accessed):
+        """
+        Records the time at which player seasons were last accessed.
+
+        Arguments:
+            keys     : List of (player ID, season) tuples
+            accessed : Access time as a UNIX timestamp
+        """
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE player_seasons SET accessed = ?"
+                " WHERE player_id = ? AND season = ?",
+                [(accessed, player_id, season) for player_id, season in keys])
+
+    def list_player_seasons(self):
+        """
+        Lists the stored player seasons, least-recently-used first.
+
+        Returns:
+            a list of rows with the player_id, season, updated, accessed, and
+            games (number of stored games) fields
+        """
+        return self.conn.execute(
+            "SELECT ps.player_id, ps.season, ps.updated, ps.accessed,"
+            " COUNT(s.id) AS games FROM player_seasons ps"
+            " LEFT JOIN stats s"
+            " ON s.player_id = ps.player_id AND s.season = ps.season"
+            " GROUP BY ps.player_id, ps.season"
+            " ORDER BY COALESCE(ps.accessed, ps.updated, 0)").fetchall()
+
+    def delete_player_seasons(self, keys):
+        """
+        Deletes the stored game statistics for player seasons, along with any
+        games which are no longer referenced.
+
+        Arguments:
+            keys : List of (player ID, season) tuples
+        """
+        with self.conn:
+            for player_id, season in keys:
+                self.conn.execute(
+                    "DELETE FROM stats WHERE player_id = ? AND season = ?",
+                    (player_id, season))
+                self.conn.execute(
+                    "DELETE FROM player_seasons"
+                    " WHERE player_id = ? AND season = ?",
+                    (player_id, season))
+                self._invalidate_player_season_aggregates(player_id, season)
+            self.conn.execute(
+                "DELETE FROM games"
+                " WHERE id NOT IN (SELECT game_id FROM stats)")
+
+    def size(self):
+        """
+        Gets the size of the data stored in the database, excluding free
+        pages.
+
+        Returns:
+            the size in bytes
+        """
+        page_size = self.conn.execute("PRAGMA page_size").fetchone()[0]
+        pages = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        free = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return (pages - free) * page_size
+
+    def count(self, table):
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM %s" % table).fetchone()[0]
+
+    def vacuum(self):
+        """
+        Rebuilds the database file, returning free pages to the filesystem.
+        """
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.conn.execute("VACUUM")
+
+    def load_player_game_stats(self, player_id, season):
+        """
+        Loads the game statistics for the given player and season, sorted
+        chronologically.
+
+        Arguments:
+            player_id : Player ID
+            season    : NBA season
+
+        Returns:
+            a list of player game stats as JSON objects, or None if the season
+            has not been stored for the player
+        """
+        if not self.has_player_game_stats(player_id, season):
+            return None
+        rows = self.conn.execute(
+            "SELECT s.id, s.player_id, %s, %s, %s FROM stats s"
+            " JOIN games g ON g.id = s.game_id"
+            " LEFT JOIN teams t ON t.id = s.team_id"
+            " WHERE s.player_id = ? AND s.season = ?"
+            " ORDER BY g.date, s.id"
+            % (columns(STAT_FIELDS, "s."),
+               ", ".join("g.%s AS game_%s" % (f, f) for f in GAME_FIELDS),
+               ", ".join("t.%s AS team_%s" % (f, f) for f in TEAM_FIELDS)),
+            (player_id, season))
+        stats = []
+        for row in rows:
+            obj = {field: row[field] for field in STAT_FIELDS}
+            obj["id"] = row["id"]
+            obj["player"] = {"id": row["player_id"]}
+            obj["game"] = {
+                field: row["game_" + field] for field in GAME_FIELDS}
+            obj["team"] = self._team_json(row)
+            stats.append(obj)
+        return stats
+
+    def store_player_game_stats(self, player_id, season, stats, complete=True):
+        """
+        Stores the game statistics for the given player and season, replacing
+        any previously stored statistics for the season.
+
+        Arguments:
+            player_id : Player ID
+            season    : NBA season
+            stats     : List of player game stats as JSON objects
+            complete  : False if the season has not ended, so that later games
+                        are merged in and the season is stored again in full
+                        once it ends
+        """
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM stats WHERE player_id = ? AND season = ?",
+                (player_id, season))
+            for obj in stats:
+                self._insert_stats(player_id, season, obj)
+            self._update_player_season(player_id, season, complete)
+            self._invalidate_player_season_aggregates(player_id, season)
+
+    def merge_player_game_stats(self, player_id, season, stats):
+        """
+        Merges game statistics into the stored statistics for the given player
+        and season, replacing any games that were already stored.
+
+        Arguments:
+            player_id : Player ID
+            season    : NBA season
+            stats     : List of player game stats as JSON objects
+        """
+        # skip games which are unchanged so that re-syncing does not write
+        stored = self.load_player_game_stats(player_id, season)
+        if stored is not None:
+            stored = {obj["id"]: obj for obj in stored}
+            stats = [
+                obj for obj in stats
+                if stored.get(obj["id"]) != self.normalize_stats(obj)]
+            if not stats:
+                return
+        with self.conn:
+            for obj in stats:
+                self._insert_stats(player_id, season, obj)
+            # merged seasons are still in progress
+            self._update_player_season(player_id, season, False)
+            self._invalidate_player_season_aggregates(player_id, season)
+
+    def _update_player_season(self, player_id, season, complete):
+        # the access time is kept, see touch_player_seasons
+        self.conn.execute(
+            "INSERT INTO player_seasons (player_id, season, updated, complete)"
+            " VALUES (?, ?, ?, ?) ON CONFLICT (player_id, season) DO UPDATE"
+            " SET updated = excluded.updated, complete = excluded.complete",
+            (player_id, season, time.time(), int(complete)))
+
+    def load_player_season_aggregates(self, player_id, season):
+        """
+        Loads the materialized aggregates for the given player and season.
+
+        Arguments:
+            player_id : Player ID
+            season    : NBA season
+
+        Returns:
+            a dict with the games (number of games played, excluding DNPs),
+            dnp, and sums (totals of each of AGGREGATE_FIELDS over the games
+            played) fields, or None if the aggregates are not stored
+        """
+        row = self.conn.execute(
+            "SELECT games, dnp, %s FROM player_season_aggregates"
+            " WHERE player_id = ? AND season = ?"
+            % columns(AGGREGATE_FIELDS), (player_id, season)).fetchone()
+        if row is None:
+            return None
+        return {
+            "games": row["games"],
+            "dnp": row["dnp"],
+            "sums": {field: row[field] for field in AGGREGATE_FIELDS},
+        }
+
+    def store_player_season_aggregates(
+        self, player_id, season, games, dnp, sums,
+    ):
+        """
+        Stores the materialized aggregates for the given player and season,
+        computed from the stored game statistics. The aggregates are removed
+        when games are stored/merged into the season or it is deleted.
+
+        Arguments:
+            player_id : Player ID
+            season    : NBA season
+            games     : Number of games played, excluding DNPs
+            dnp       : Number of DNPs
+            sums      : Dict mapping each of AGGREGATE_FIELDS to its total
+        """
+        fields = ["player_id", "season", "games", "dnp"] + AGGREGATE_FIELDS
+        values = [player_id, season, games, dnp] + [
+            sums[field] for field in AGGREGATE_FIELDS]
+        with self.conn:
+            self._upsert("player_season_aggregates", fields, values)
+
+    def _invalidate_player_season_aggregates(self, player_id, season):
+        self.conn.execute(
+            "DELETE FROM player_season_aggregates"
+            " WHERE player_id = ? AND season = ?", (player_id, season))
+
+    @staticmethod
+    def normalize_stats(obj):
+        """
+        Converts player game stats from the API into the form they are stored
+        and loaded in, dropping any fields which are not stored.
+
+        Arguments:
+            obj : Player game stats as a JSON object
+
+        Returns:
+            the normalized JSON object
+        """
+        norm = {field: obj.get(field) for field in STAT_FIELDS}
+        if norm["min"] is not None:
+            norm["min"] = str(norm["min"])
+        norm["id"] = obj["id"]
+        norm["player"] = {"id": (obj.get("player") or {}).get("id")}
+        game = obj.get("game") or {}
+        norm["game"] = {field: game.get(field) for field in GAME_FIELDS}
+        team = obj.get("team")
+        norm["team"] = (
+            {field: team.get(field) for field in TEAM_FIELDS}
+            if team else None)
+        return norm
+
+    def get_player_game_stats_mark(self, player_id, season):
+        """
+        Gets the high-water mark of the stored game statistics for the given
+        player and season i.e. the most recent game.
+
+        Arguments:
+            player_id : Player ID
+            season    : NBA season
+
+        Returns:
+            a tuple of the date and ID of the most recent stored game, or None
+            if no games are stored
+        """
+        row = self.conn.execute(
+            "SELECT g.date, g.id FROM stats s JOIN games g ON g.id = s.game_id"
+            " WHERE s.player_id = ? AND s.season = ?"
+            " ORDER BY g.date DESC, g.id DESC LIMIT 1",
+            (player_id, season)).fetchone()
+        return (row["date"], row["id"]) if row else None
+
+    def _insert_stats(self, player_id, season, obj):
+        game = obj["game"]
+        team = obj.get("team") or {}
+        self._upsert_team(team)
+        self._upsert(
+            "games", GAME_FIELDS, [game.get(field) for field in GAME_FIELDS])
+        team_id = team.get("id")
+        if team_id == game.get("home_team_id"):
+            opponent_id = game.get("visitor_team_id")
+        else:
+            opponent_id = game.get("home_team_id")
+        fields = [
+            "id", "player_id", "game_id", "team_id", "opponent_id", "season",
+        ] + STAT_FIELDS
+        values = [
+            obj["id"], player_id, game["id"], team_id, opponent_id, season,
+        ] + [obj.get(field) for field in STAT_FIELDS]
+        self._upsert("stats", fields, values)
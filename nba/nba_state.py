@@ -13,33 +13,129 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import operator
+import bisect
+
+
+def normalize_name(name):
+    """
+    Normalizes a player name for case-insensitive lookups.
+    """
+    return (name or "").upper()
 
 
 class NBAState:
     """
-    Global store for NBA information and statistics.
+    Global store for NBA information and statistics. Players and teams are
+    indexed by ID, players by normalized first/last name and by name prefix,
+    and teams by abbreviation, so that lookups do not scan every record.
     """
-    players = []
-    player_ids = set()  # used to avoid duplication of player objects
-    teams = []
+
+    def __init__(self):
+        self.player_ids = {}  # player ID to Player, in insertion order
+        self.dirty_player_ids = set()  # players added/changed since loading
+        self.first_names = {}  # normalized first name to Players
+        self.last_names = {}  # normalized last name to Players
+        # sorted list of (normalized first/last/full name, player ID) tuples
+        self.name_prefixes = []
+        self.set_teams([])
+
+    @property
+    def players(self):
+        return list(self.player_ids.values())
 
     def set_players(self, nba_players):
-        self.players = nba_players
-        for player in self.players:
-            self.player_ids.add(player.id)
+        self.player_ids = {}
+        self.dirty_player_ids = set()
+        self.first_names = {}
+        self.last_names = {}
+        self.name_prefixes = []
+        for player in nba_players:
+            self._index_player(player)
+
+    @staticmethod
+    def _player_names(player):
+        first = normalize_name(player.first_name)
+        last = normalize_name(player.last_name)
+        return first, last, "%s %s" % (first, last)
+
+    def _index_player(self, player):
+        self.player_ids[player.id] = player
+        first, last, full = self._player_names(player)
+        self.first_names.setdefault(first, []).append(player)
+        self.last_names.setdefault(last, []).append(player)
+        for name in set([first, last, full]):
+            bisect.insort(self.name_prefixes, (name, player.id))
+
+    def _unindex_player(self, player):
+        first, last, full = self._player_names(player)
+        for index, name in [
+            (self.first_names, first), (self.last_names, last),
+        ]:
+            players = [p for p in index[name] if p.id != player.id]
+            if players:
+                index[name] = players
+            else:
+                del index[name]
+        for name in set([first, last, full]):
+            i = bisect.bisect_left(self.name_prefixes, (name, player.id))
+            del self.name_prefixes[i]
 
     def add_player(self, player):
-        if player.id not in self.player_ids:
-            self.players.append(player)
-            self.player_ids.add(player.id)
+        """
+        Adds a player to the state, replacing the stored player with the same
+        ID if it has changed. New and changed players are marked as dirty.
 
-    def add_players(self, player_list):
+        Arguments:
+            player : Player object
+        """
+        stored = self.player_ids.get(player.id)
+        if stored is None:
+            self._index_player(player)
+            self.dirty_player_ids.add(player.id)
+        elif stored.toJSON() != player.toJSON():
+            self._unindex_player(stored)
+            self._index_player(player)
+            self.dirty_player_ids.add(player.id)
+
+    def add_players(self, player_list, dirty=True):
+        """
+        Adds players to the state.
+
+        Arguments:
+            player_list : List of Player objects
+            dirty       : Mark new/changed players as dirty, should be unset
+                          for players that were loaded from local storage
+        """
         for player in player_list:
             self.add_player(player)
+            if not dirty:
+                self.dirty_player_ids.discard(player.id)
+
+    def pop_dirty_players(self):
+        """
+        Gets the players that have been added or changed since they were
+        loaded, and clears their dirty state.
+
+        Returns:
+            a list of Player objects
+        """
+        players = [
+            self.player_ids[player_id]
+            for player_id in sorted(self.dirty_player_ids)]
+        self.dirty_player_ids = set()
+        return players
+
+    def get_player(self, player_id):
+        return self.player_ids.get(player_id)
 
     def set_teams(self, nba_teams):
         self.teams = nba_teams
+        self.team_ids = {team.id: team for team in nba_teams}
+        self.team_abbreviations = {
+            team.abbreviation: team for team in nba_teams}
+
+    def get_team(self, team_id):
+        return self.team_ids.get(team_id)
 
     def filter_players(self, names):
         """
@@ -56,18 +152,38 @@ class NBAState:
             names = list(names)
 
         if len(names) > 1:
-            first = names[0].upper()
-            last = " ".join(names[1:]).upper()
-            combinator = operator.__and__
-        else:
-            first = names[0].upper()
-            last = names[0].upper()
-            combinator = operator.__or__
-
-        return [
-            p for p in self.players
-            if combinator(
-                p.first_name.upper() == first, p.last_name.upper() == last)]
+            first = normalize_name(names[0])
+            last = normalize_name(" ".join(names[1:]))
+            return [
+                p for p in self.first_names.get(first, [])
+                if normalize_name(p.last_name) == last]
+
+        name = normalize_name(names[0])
+        matches = {}
+        for index in [self.first_names, self.last_names]:
+            for p in index.get(name, []):
+                matches[p.id] = p
+        return list(matches.values())
+
+    def filter_players_by_prefix(self, prefix):
+        """
+        Filters the player list for players whose first, last, or full name
+        starts with the given string.
+
+        Arguments:
+            prefix : Partial player name
+
+        Returns:
+            a list of matching Player objects, sorted by the matching name
+        """
+        prefix = normalize_name(prefix)
+        i = bisect.bisect_left(self.name_prefixes, (prefix,))
+        matches = {}
+        for name, player_id in self.name_prefixes[i:]:
+            if not name.startswith(prefix):
+                break
+            matches.setdefault(player_id, self.player_ids[player_id])
+        return list(matches.values())
 
     def filter_teams(self, key):
         """
@@ -80,9 +196,10 @@ class NBAState:
             a list of matching Team objects
         """
         # match the abbreviation or anything in the full name
-        return [
-            t for t in self.teams
-            if t.abbreviation == key or key in t.full_name]
+        team = self.team_abbreviations.get(key)
+        if team is not None:
+            return [team]
+        return [t for t in self.teams if key in t.full_name]
 
     def team_id_to_abbreviation(self, team_id):
         """
@@ -95,5 +212,5 @@ class NBAState:
         Returns:
             team abbreviation string
         """
-        matches = [team for team in self.teams if team.id == team_id]
-        return matches[0].abbreviation if matches else ""
+        team = self.team_ids.get(team_id)
+        return team.abbreviation if team is not None else ""
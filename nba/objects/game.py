@@ -15,18 +15,53 @@
 
 import datetime
 
+FIELDS = [
+    "id", "date", "home_team_id", "home_team_score", "season",
+    "visitor_team_id", "visitor_team_score",
+]
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+
+def parse_date(date):
+    """
+    Parses a game date from the API i.e. 2022-11-20T00:00:00.000Z.
+
+    Arguments:
+        date : Date string, or None
+
+    Returns:
+        the datetime.datetime object, or None if no date was provided
+    """
+    if not date:
+        return None
+    # fast path for the ISO 8601 format used by the API, fromisoformat does
+    # not accept the trailing "Z" on all supported Python versions
+    if date.endswith("Z"):
+        try:
+            return datetime.datetime.fromisoformat(date[:-1])
+        except ValueError:
+            pass
+    return datetime.datetime.strptime(date, DATE_FORMAT)
+
 
 class Game:
     """
-    Stores game information.
+    Stores game information. Games embedded in other records should be created
+    with Game.intern so that a single object is shared per game.
     """
 
+    # the date is parsed once, along with a key to sort games by date
+    __slots__ = FIELDS + ["sort_key", "_datetime"]
+    # shared games by ID, as (field values, Game object) tuples
+    _registry = {}
+
     def __init__(
         self,
         id=None, date=None, home_team_id=None, home_team_score=None,
         season=None, visitor_team_id=None, visitor_team_score=None,
         **kwargs,
     ):
+        # fields which are not stored are ignored
         self.id = id
         self.date = date
         self.home_team_id = home_team_id
@@ -34,9 +69,35 @@ class Game:
         self.season = season
         self.visitor_team_id = visitor_team_id
         self.visitor_team_score = visitor_team_score
+        self._datetime = parse_date(date)
+        self.sort_key = (
+            self._datetime.toordinal() if self._datetime else 0, id or 0)
 
     def toJSON(self):
-        return self.__dict__
+        return {field: getattr(self, field) for field in FIELDS}
+
+    @classmethod
+    def intern(cls, obj):
+        """
+        Gets the shared Game object for the given game info, creating it if
+        the game has not been seen or its info has changed i.e. the score of a
+        game in progress.
+
+        Arguments:
+            obj : Game info as a JSON object
+
+        Returns:
+            the Game object
+        """
+        key = obj.get("id")
+        values = tuple(map(obj.get, FIELDS))
+        entry = cls._registry.get(key)
+        if entry is not None and entry[0] == values:
+            return entry[1]
+        game = cls(**obj)
+        if key is not None:
+            cls._registry[key] = (values, game)
+        return game
 
     def date_to_datetime(self):
-        return datetime.datetime.strptime(self.date, "%Y-%m-%dT%H:%M:%S.%fZ")
+        return self._datetime
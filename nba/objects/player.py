@@ -21,20 +21,23 @@ class Player:
     Stores player information and statistics.
     """
 
+    __slots__ = ["id", "first_name", "last_name", "position", "team"]
+
     def __init__(
         self,
         id=None, first_name=None, last_name=None, position=None, team=None,
         **kwargs,
     ):
+        # fields which are not stored are ignored
         self.id = id
         self.first_name = first_name
         self.last_name = last_name
         self.position = position
-        self.team = Team(**team) if team else team
+        self.team = Team.intern(team) if team else team
 
     def toJSON(self):
-        obj = self.__dict__
-        obj["team"] = self.team.toJSON()
+        obj = {field: getattr(self, field) for field in self.__slots__}
+        obj["team"] = self.team.toJSON() if self.team else None
         return obj
 
     @property
@@ -17,8 +17,7 @@ from .game import Game
 from .team import Team
 
 from .. import utils
-
-import collections
+from ..stats_table import StatsTable
 
 
 class PlayerGameStats:
@@ -26,6 +25,12 @@ class PlayerGameStats:
     Stores player statistics from a specific game.
     """
 
+    __slots__ = [
+        "id", "ast", "blk", "dreb", "fg3_pct", "fg3a", "fg3m", "fg_pct", "fga",
+        "fgm", "ft_pct", "fta", "ftm", "game", "gp", "min", "oreb", "pf",
+        "pts", "reb", "stl", "team", "turnover",
+    ]
+
     def __init__(
         self,
         id=None, ast=None, blk=None, dreb=None, fg3_pct=None, fg3a=None,
@@ -34,6 +39,7 @@ class PlayerGameStats:
         reb=None, stl=None, team=None, turnover=None,
         **kwargs,
     ):
+        # fields which are not stored are ignored i.e. the player
         self.id = id
         self.ast = ast
         self.blk = blk
@@ -47,7 +53,7 @@ class PlayerGameStats:
         self.ft_pct = ft_pct
         self.fta = fta
         self.ftm = ftm
-        self.game = Game(**game) if game else None
+        self.game = Game.intern(game) if game else None
         self.gp = gp
         self.min = utils.min_to_number(min)
         self.oreb = oreb
@@ -55,13 +61,13 @@ class PlayerGameStats:
         self.pts = pts
         self.reb = reb
         self.stl = stl
-        self.team = Team(**team) if team else None
+        self.team = Team.intern(team) if team else None
         self.turnover = turnover
 
     def toJSON(self):
-        obj = self.__dict__
-        obj["game"] = self.game.toJSON()
-        obj["team"] = self.team.toJSON()
+        obj = {field: getattr(self, field) for field in self.__slots__}
+        obj["game"] = self.game.toJSON() if self.game else None
+        obj["team"] = self.team.toJSON() if self.team else None
         return obj
 
     def is_dnp(self):
@@ -77,23 +83,14 @@ class PlayerGameStats:
             filter_dnp : Filter out games that are classified as DNPs
 
         Returns:
-            a PlayerGameStats object containing the averages
+            a PlayerGameStats object containing the averages, or None if there
+            are no games to average
         """
+        table = StatsTable.from_stats(stats_list)
         # filter out DNPs, if requested
         if filter_dnp:
-            stats_list = [game for game in stats_list if not game.is_dnp()]
-        # convert each object to JSON
-        ngames = len(stats_list)
-        stats_json = [game.toJSON() for game in stats_list]
-        # combine averages
-        skip_keys = ["id", "fg3_pct", "fg_pct", "ft_pct", "game", "gp", "team"]
-        averages_json = collections.defaultdict(float)
-        for game in stats_json:
-            for key, value in game.items():
-                if key in skip_keys:
-                    continue
-                averages_json[key] += value
-        averages_json = {k: v / ngames for k, v in averages_json.items()}
+            table = table.without_dnp()
+        if not len(table):
+            return None
         # include the additional "games played" key
-        averages_json["gp"] = ngames
-        return PlayerGameStats(**averages_json)
+        return PlayerGameStats(gp=len(table), **table.means())
@@ -16,15 +16,24 @@
 
 class Team:
     """
-    Stores team information.
+    Stores team information. Teams embedded in other records should be created
+    with Team.intern so that a single object is shared per team.
     """
 
+    __slots__ = [
+        "id", "abbreviation", "city", "conference", "division", "full_name",
+        "name",
+    ]
+    # shared teams by ID, as (field values, Team object) tuples
+    _registry = {}
+
     def __init__(
         self,
         id=None, abbreviation=None, city=None, conference=None, division=None,
         full_name=None, name=None,
         **kwargs,
     ):
+        # fields which are not stored are ignored
         self.id = id
         self.abbreviation = abbreviation
         self.city = city
@@ -34,4 +43,26 @@ class Team:
         self.name = name
 
     def toJSON(self):
-        return self.__dict__
\ No newline at end of file
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    @classmethod
+    def intern(cls, obj):
+        """
+        Gets the shared Team object for the given team info, creating it if
+        the team has not been seen or its info has changed.
+
+        Arguments:
+            obj : Team info as a JSON object
+
+        Returns:
+            the Team object
+        """
+        key = obj.get("id")
+        values = tuple(map(obj.get, cls.__slots__))
+        entry = cls._registry.get(key)
+        if entry is not None and entry[0] == values:
+            return entry[1]
+        team = cls(**obj)
+        if key is not None:
+            cls._registry[key] = (values, team)
+        return team
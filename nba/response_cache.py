@@ -0,0 +1,270 @@
+# Copyright (C) 2022  Ian Brault
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from . import codec
+from . import compression
+from . import log
+
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
+import os
+import time
+
+# maximum total size of the cached responses, in bytes
+MAX_SIZE = 64 * 1024 * 1024
+# time-to-live for cached responses, by endpoint, in seconds
+TTLS = {
+    "/api/v1/teams": 7 * 24 * 60 * 60,
+    "/api/v1/players": 24 * 60 * 60,
+    "/api/v1/stats": 10 * 60,
+}
+DEFAULT_TTL = 60 * 60
+
+
+def normalize_url(url):
+    """
+    Normalizes a URL query string so that equivalent queries share a key,
+    regardless of the order in which the query parameters were provided.
+
+    Arguments:
+        url : URL string, as built by api.build_url
+
+    Returns:
+        the normalized URL string
+    """
+    base, _, query = url.partition("?")
+    if not query:
+        return base
+    return "%s?%s" % (base, "&".join(sorted(query.split("&"))))
+
+
+class CacheEntry:
+    """
+    Stores a cached response along with its validators.
+    """
+
+    def __init__(
+        self,
+        url=None, body=None, stored=None, etag=None, last_modified=None,
+        **kwargs,
+    ):
+        self.url = url
+        self.body = body
+        self.stored = stored
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def toJSON(self):
+        return dict(self.__dict__)
+
+    def age(self):
+        return time.time() - self.stored
+
+    def validators(self):
+        """
+        Returns the conditional request headers used to revalidate the entry.
+        """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """
+    On-disk cache of JSON responses keyed by the normalized query URL. Entries
+    are served without a request until their endpoint TTL expires, at which
+    point they are revalidated with the server if it provided an ETag or
+    Last-Modified header. The least-recently-used entries are evicted once the
+    cache grows past its maximum size. Entries are compressed and checksummed,
+    truncated or corrupt entries are treated as missing.
+
+    From a coroutine, the cache should be accessed through run(), so that file
+    I/O and decoding do not block the event loop.
+    """
+
+    def __init__(self, directory, max_size=MAX_SIZE, ttls=None, method=None):
+        self.directory = directory
+        self.max_size = max_size
+        # compression method, one of compression.METHODS, defaults to the
+        # preferred installed method
+        self.method = method
+        self.ttls = dict(TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        # entries that have been loaded/stored by this process
+        self.entries = {}
+        # total size of the on-disk entries, computed on the first store
+        self.size = None
+        self.executor = None
+
+    async def run(self, func, *args):
+        """
+        Runs a cache method on the cache thread, see Database.run. Methods are
+        run one at a time, in the order they are submitted.
+
+        Arguments:
+            func : Function to run i.e. a ResponseCache method
+            args : Function arguments
+
+        Returns:
+            the value returned by the function
+        """
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="nba-responses")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(func, *args))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def path(self, url):
+        digest = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return self.directory / ("%s.json" % digest)
+
+    def ttl(self, url):
+        """
+        Gets the time-to-live for the given URL, based on its endpoint.
+        """
+        base = url.partition("?")[0]
+        return self.ttls.get(base, DEFAULT_TTL)
+
+    def is_fresh(self, entry):
+        return entry.age() < self.ttl(entry.url)
+
+    def get(self, url):
+        """
+        Gets the cached entry for the given URL.
+
+        Arguments:
+            url : Normalized URL string
+
+        Returns:
+            the CacheEntry object, or None if the URL is not cached
+        """
+        entry = self.entries.get(url)
+        if entry is not None:
+            return entry
+        path = self.path(url)
+        try:
+            with path.open("rb") as f:
+                data = compression.unframe(f.read())
+            entry = CacheEntry(**codec.loads(data))
+            # update the modification time to track recency for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (IOError, OSError, ValueError, TypeError) as ex:
+            log.debug("discarding cached response %s: %s" % (path.name, ex))
+            return None
+        # guard against hash collisions
+        if entry.url != url:
+            return None
+        self.entries[url] = entry
+        return entry
+
+    def put(self, url, body, etag=None, last_modified=None):
+        """
+        Stores a response in the cache.
+
+        Arguments:
+            url           : Normalized URL string
+            body          : Response JSON data
+            etag          : Response ETag header, if provided
+            last_modified : Response Last-Modified header, if provided
+
+        Returns:
+            the CacheEntry object
+        """
+        entry = CacheEntry(
+            url=url, body=body, stored=time.time(), etag=etag,
+            last_modified=last_modified)
+        self.entries[url] = entry
+        self.write(entry)
+        return entry
+
+    def revalidate(self, entry):
+        """
+        Marks an entry as fresh after the server confirmed it is unmodified.
+        """
+        entry.stored = time.time()
+        self.write(entry)
+
+    def write(self, entry):
+        path = self.path(entry.url)
+        tmp = path.with_suffix(".tmp")
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            if self.size is None:
+                self.size = self.disk_usage()
+            if path.exists():
+                self.size -= path.stat().st_size
+            with tmp.open("wb") as f:
+                f.write(compression.frame(
+                    codec.dumps(entry.toJSON()), self.method))
+            os.replace(tmp, path)
+            self.size += path.stat().st_size
+        except (IOError, OSError) as ex:
+            log.error("failed to cache response for %s: %s" % (entry.url, ex))
+            return
+        if self.size > self.max_size:
+            self.evict()
+
+    def disk_usage(self):
+        paths = self.directory.glob("*.json")
+        return sum(path.stat().st_size for path in paths)
+
+    def evict(self, target=None):
+        """
+        Removes the least-recently-used entries until the cache is below the
+        target size, by default leaving some headroom below the maximum size
+        to avoid evicting on every store.
+
+        Arguments:
+            target : Target size in bytes
+
+        Returns:
+            the number of bytes removed
+        """
+        if target is None:
+            target = self.max_size * 0.9
+        if self.size is None:
+            self.size = self.disk_usage() if self.directory.exists() else 0
+        start = self.size
+        paths = sorted(
+            self.directory.glob("*.json"), key=lambda p: p.stat().st_mtime)
+        for path in paths:
+            if self.size <= target:
+                break
+            try:
+                size = path.stat().st_size
+                path.unlink()
+            except (IOError, OSError):
+                continue
+            self.size -= size
+            log.debug("evicted cached response %s" % path.name)
+        # drop in-memory entries whose files were evicted
+        self.entries = {
+            url: entry for url, entry in self.entries.items()
+            if self.path(url).exists()}
+        return start - self.size
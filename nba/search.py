@@ -0,0 +1,156 @@
+# Copyright (C) 2022  Ian Brault
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import unicodedata
+
+# minimum similarity for a player to be a search candidate
+THRESHOLD = 0.5
+# minimum similarity for a candidate to be used without querying the API, only
+# names which are the same once folded i.e. accent/case variants qualify
+MATCH = 1.0
+# minimum lead in similarity for the best candidate to be an unambiguous match
+MARGIN = 0.15
+
+
+def fold(name):
+    """
+    Folds a name for fuzzy matching: accents are removed, case is folded, and
+    punctuation is dropped i.e. "Dončić" and "D'Angelo" become "doncic" and
+    "dangelo".
+
+    Arguments:
+        name : Name string
+
+    Returns:
+        the folded name string
+    """
+    name = name or ""
+    if name.isascii():
+        # fast path, there are no accents to remove
+        chars = [c for c in name if c.isalnum() or c.isspace()]
+    else:
+        chars = [
+            c for c in unicodedata.normalize("NFKD", name)
+            if not unicodedata.combining(c) and (c.isalnum() or c.isspace())]
+    return " ".join("".join(chars).casefold().split())
+
+
+def trigrams(name):
+    """
+    Gets the set of trigrams for a name. Each word is padded so that the start
+    and end of words are weighted more heavily.
+
+    Arguments:
+        name : Name string
+
+    Returns:
+        a set of trigram strings
+    """
+    return folded_trigrams(fold(name))
+
+
+def folded_trigrams(folded):
+    """
+    Gets the set of trigrams for a name which has already been folded.
+    """
+    grams = set()
+    for word in folded.split():
+        padded = "  %s " % word
+        for i in range(len(padded) - 2):
+            grams.add(padded[i:i + 3])
+    return grams
+
+
+def similarity(a, b):
+    """
+    Computes the similarity of two trigram sets, from 0 to 1.
+    """
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+def player_trigrams(player):
+    """
+    Gets the set of trigrams which are indexed for a player.
+    """
+    first = player.get("first_name") or ""
+    last = player.get("last_name") or ""
+    return trigrams("%s %s" % (first, last))
+
+
+def score(query, grams, player):
+    """
+    Scores how well a player matches a search query, by their first, last, or
+    full name. Exact matches, ignoring accents/case/punctuation, score 1.
+
+    Arguments:
+        query  : Folded search query string, see fold()
+        grams  : Trigrams of the query
+        player : Player info as a JSON object
+
+    Returns:
+        the score, from 0 to 1
+    """
+    first = fold(player.get("first_name"))
+    last = fold(player.get("last_name"))
+    if query in (first, last, "%s %s" % (first, last)):
+        return 1.0
+    first_grams = folded_trigrams(first)
+    last_grams = folded_trigrams(last)
+    return max(
+        similarity(grams, first_grams), similarity(grams, last_grams),
+        similarity(grams, first_grams | last_grams))
+
+
+def rank(query, players, threshold=THRESHOLD):
+    """
+    Ranks players by how well they match a search query.
+
+    Arguments:
+        query     : Search query string
+        players   : List of player info as JSON objects
+        threshold : Minimum score for a player to be included
+
+    Returns:
+        a list of (score, player) tuples, best match first
+    """
+    query = fold(query)
+    grams = folded_trigrams(query)
+    scored = [(score(query, grams, player), player) for player in players]
+    scored = [(s, player) for s, player in scored if s >= threshold]
+    scored.sort(key=lambda pair: (-pair[0], pair[1]["id"]))
+    return scored
+
+
+def best_match(ranked, minimum=MATCH, margin=MARGIN):
+    """
+    Picks the unambiguous best match from ranked search results. Similar names
+    are often different players i.e. "Seth Curry" and "Stephen Curry", so by
+    default only exact matches, ignoring accents/case/punctuation, are picked.
+
+    Arguments:
+        ranked  : List of (score, player) tuples, as returned by rank()
+        minimum : Minimum score for the best candidate
+        margin  : Minimum lead over the next candidate
+
+    Returns:
+        the best matching player, or None if there is no clear best match
+    """
+    if not ranked or ranked[0][0] < minimum:
+        return None
+    if len(ranked) > 1 and ranked[0][0] - ranked[1][0] < margin:
+        return None
+    return ranked[0][1]
@@ -0,0 +1,194 @@
+# Copyright (C) 2022  Ian Brault
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import array
+import math
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# counting stats which are summed/averaged, minutes are stored as numbers
+STAT_FIELDS = [
+    "ast", "blk", "dreb", "fg3a", "fg3m", "fga", "fgm", "fta", "ftm", "min",
+    "oreb", "pf", "pts", "reb", "stl", "turnover",
+]
+# shooting percentages, as (makes, attempts) fields
+SHOOTING_FIELDS = {
+    "fg_pct": ("fgm", "fga"),
+    "fg3_pct": ("fg3m", "fg3a"),
+    "ft_pct": ("ftm", "fta"),
+}
+
+
+def _column(values):
+    # missing stats count as 0
+    if numpy is not None:
+        # NumPy converts None to NaN
+        return numpy.nan_to_num(
+            numpy.array(values, dtype=numpy.float64), copy=False)
+    try:
+        return array.array("d", values)
+    except TypeError:
+        return array.array("d", [0.0 if v is None else v for v in values])
+
+
+class StatsTable:
+    """
+    Stores a player's game statistics as one array per stat, so that sums and
+    averages are computed over whole columns rather than game by game. Columns
+    are NumPy arrays when NumPy is installed, otherwise array.array objects.
+    """
+
+    def __init__(self, columns, ngames):
+        self.columns = columns
+        self.ngames = ngames
+
+    @classmethod
+    def from_stats(cls, stats_list):
+        """
+        Builds a table from player game stats.
+
+        Arguments:
+            stats_list : List of PlayerGameStats objects
+
+        Returns:
+            the StatsTable object
+        """
+        stats_list = list(stats_list)
+        getter = operator.attrgetter(*STAT_FIELDS)
+        rows = [getter(stats) for stats in stats_list]
+        columns = {}
+        for i, field in enumerate(STAT_FIELDS):
+            columns[field] = _column([row[i] for row in rows])
+        return cls(columns, len(stats_list))
+
+    def __len__(self):
+        return self.ngames
+
+    def column(self, field):
+        return self.columns[field]
+
+    def dnp_mask(self):
+        """
+        Gets the games which are classified as DNPs i.e. with no minutes.
+
+        Returns:
+            a list/array of booleans, one per game
+        """
+        minutes = self.columns["min"]
+        if numpy is not None:
+            return minutes == 0
+        return [m == 0 for m in minutes]
+
+    def filter(self, mask):
+        """
+        Gets a table with only the selected games.
+
+        Arguments:
+            mask : List/array of booleans, one per game
+
+        Returns:
+            the StatsTable object
+        """
+        if numpy is not None:
+            mask = numpy.asarray(mask, dtype=bool)
+            columns = {
+                field: column[mask] for field, column in self.columns.items()}
+            return StatsTable(columns, int(mask.sum()))
+        columns = {
+            field: array.array(
+                "d", (value for value, keep in zip(column, mask) if keep))
+            for field, column in self.columns.items()}
+        return StatsTable(columns, sum(1 for keep in mask if keep))
+
+    def without_dnp(self):
+        """
+        Gets a table with the DNPs filtered out.
+        """
+        if numpy is not None:
+            return self.filter(~self.dnp_mask())
+        return self.filter([not dnp for dnp in self.dnp_mask()])
+
+    def sum(self, field):
+        column = self.columns[field]
+        if numpy is not None:
+            return float(column.sum())
+        return math.fsum(column)
+
+    def mean(self, field):
+        if not self.ngames:
+            return 0.0
+        return self.sum(field) / self.ngames
+
+    def sums(self):
+        return {field: self.sum(field) for field in STAT_FIELDS}
+
+    def means(self):
+        return {field: self.mean(field) for field in STAT_FIELDS}
+
+    def percentage(self, field):
+        """
+        Gets a shooting percentage over all games i.e. total makes divided by
+        total attempts.
+
+        Arguments:
+            field : Shooting percentage field, one of SHOOTING_FIELDS
+
+        Returns:
+            the percentage as a float, 0 if there were no attempts
+        """
+        makes, attempts = SHOOTING_FIELDS[field]
+        total = self.sum(attempts)
+        if total == 0:
+            return 0.0
+        return self.sum(makes) / total * 100.0
+
+    def per_game_percentage(self, field):
+        """
+        Gets a shooting percentage for each game.
+
+        Arguments:
+            field : Shooting percentage field, one of SHOOTING_FIELDS
+
+        Returns:
+            a list/array of percentages, 0 for games without attempts
+        """
+        makes, attempts = SHOOTING_FIELDS[field]
+        return self._ratio(makes, attempts, 100.0)
+
+    def per36(self, field):
+        """
+        Gets a stat per 36 minutes for each game.
+
+        Arguments:
+            field : Stat field, one of STAT_FIELDS
+
+        Returns:
+            a list/array of values, 0 for DNPs
+        """
+        return self._ratio(field, "min", 36.0)
+
+    def _ratio(self, numerator, denominator, scale):
+        num = self.columns[numerator]
+        den = self.columns[denominator]
+        if numpy is not None:
+            out = numpy.zeros(self.ngames)
+            numpy.divide(num * scale, den, out=out, where=den != 0)
+            return out
+        return array.array(
+            "d", (n * scale / d if d else 0.0 for n, d in zip(num, den)))
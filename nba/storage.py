@@ -13,42 +13,364 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from . import codec
+from . import columnar
+from . import compression
 from . import log
+from .database import Database
 
-import json
+import asyncio
+import concurrent.futures
+import mmap
+import os
+import re
+import time
+
+# name of the SQLite database in the local storage directory
+DATABASE_NAME = "nba.db"
+# files larger than this are decoded in a worker process, in bytes
+PROCESS_POOL_THRESHOLD = 16 * 1024 * 1024
+
+# page counts are dropped once they have not been observed for this long, in
+# seconds, and are kept up to date at most this often
+PAGE_COUNTS_TTL = 30 * 24 * 60 * 60
+PAGE_COUNTS_REFRESH = 24 * 60 * 60
+# maximum number of page counts which are kept
+MAX_PAGE_COUNTS = 1000
+
+# pool used to decode large files, created on first use
+_process_pool = None
 
 
 def load_json(path):
     """
-    Loads JSON data from the given path.
+    Loads JSON data from the given path. Compressed files are decompressed and
+    verified against their checksum, files stored without compression by
+    earlier versions are loaded as-is.
 
     Arguments:
         path : File path as a pathlib.Path object
 
     Returns:
-        the data from the file or [] if an error occurred
+        the data from the file or None if the file could not be read or is
+        truncated/corrupt
     """
-    data = []
+    data = None
     try:
         log.debug("loading data from %s" % path)
-        with path.open() as f:
-            data = json.loads(f.read())
-    except (IOError, OSError) as ex:
+        with path.open("rb") as f:
+            data = codec.loads(compression.unframe(f.read()))
+    except (IOError, OSError, ValueError) as ex:
         log.error("failed to load data from %s: %s" % (path, ex))
     return data
 
 
-def store_json(path, data):
+async def load_json_async(path):
     """
-    Stores JSON data to the given path.
+    Loads JSON data from the given path without blocking the event loop. The
+    file is read and decoded in a worker thread, or in a worker process for
+    large files so that decoding runs in parallel with the event loop.
 
     Arguments:
         path : File path as a pathlib.Path object
-        data : Data to be stored
+
+    Returns:
+        the data from the file or None if the file could not be read or is
+        truncated/corrupt
+    """
+    global _process_pool
+    loop = asyncio.get_running_loop()
+    try:
+        size = path.stat().st_size
+    except (IOError, OSError):
+        size = 0
+    if size < PROCESS_POOL_THRESHOLD:
+        return await loop.run_in_executor(None, load_json, path)
+    if _process_pool is None:
+        _process_pool = concurrent.futures.ProcessPoolExecutor()
+    return await loop.run_in_executor(_process_pool, load_json, path)
+
+
+def store_json(path, data, method=None):
+    """
+    Stores JSON data to the given path. The data is written to a temporary file
+    which then replaces the destination, so that an interrupted write never
+    leaves a partial file behind.
+
+    Arguments:
+        path   : File path as a pathlib.Path object
+        data   : Data to be stored
+        method : Compression method, one of compression.METHODS, defaults to
+                 the preferred installed method
     """
+    tmp = path.with_name(path.name + ".tmp")
     try:
         log.debug("storing data to %s" % path)
-        with path.open("w") as f:
-            f.write(json.dumps(data))
+        with tmp.open("wb") as f:
+            f.write(compression.frame(codec.dumps(data), method))
+        os.replace(tmp, path)
     except (IOError, OSError) as ex:
         log.error("failed to store data to %s: %s" % (path, ex))
+
+
+async def load_columnar_async(path):
+    """
+    Loads player game stats stored in the columnar format without blocking the
+    event loop.
+
+    Arguments:
+        path : File path as a pathlib.Path object
+
+    Returns:
+        the columnar.ColumnarStats object, or None if an error occurred
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, load_columnar, path)
+
+
+def load_columnar(path):
+    """
+    Loads player game stats stored in the columnar format. The file is memory
+    mapped so that columns are read directly from the page cache.
+
+    Arguments:
+        path : File path as a pathlib.Path object
+
+    Returns:
+        the columnar.ColumnarStats object, or None if an error occurred
+    """
+    try:
+        log.debug("loading columnar data from %s" % path)
+        with path.open("rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return columnar.decode(buffer)
+    except (IOError, OSError, ValueError) as ex:
+        log.error("failed to load data from %s: %s" % (path, ex))
+    return None
+
+
+def store_columnar(path, stats):
+    """
+    Stores player game stats in the columnar format. As with store_json, the
+    data is written to a temporary file which then replaces the destination.
+
+    Arguments:
+        path  : File path as a pathlib.Path object
+        stats : List of player game stats as JSON objects
+    """
+    tmp = path.with_name(path.name + ".tmp")
+    try:
+        log.debug("storing columnar data to %s" % path)
+        with tmp.open("wb") as f:
+            f.write(columnar.encode(stats))
+        os.replace(tmp, path)
+    except (IOError, OSError) as ex:
+        log.error("failed to store data to %s: %s" % (path, ex))
+
+
+class ColumnarSeasons:
+    """
+    Stores complete player seasons in the columnar format alongside the
+    database, so that they are read from a memory-mapped file rather than
+    queried and decoded row by row. Seasons which have not ended are only
+    stored in the database.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, player_id, season):
+        return self.directory / (
+            "player_%u_games_%u.nbac" % (player_id, season))
+
+    def load(self, player_id, season):
+        """
+        Loads the game statistics for the given player and season.
+
+        Returns:
+            a list of player game stats as JSON objects, or None if the season
+            is not stored or the file is truncated/corrupt
+        """
+        path = self.path(player_id, season)
+        if not path.exists():
+            return None
+        stats = load_columnar(path)
+        return stats.toJSON() if stats is not None else None
+
+    def store(self, player_id, season, stats):
+        """
+        Stores the game statistics for the given player and season.
+
+        Arguments:
+            player_id : Player ID
+            season    : NBA season
+            stats     : List of player game stats as JSON objects, in the form
+                        loaded from the database
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        store_columnar(self.path(player_id, season), stats)
+
+    def delete(self, keys):
+        """
+        Deletes the stored game statistics for player seasons.
+
+        Arguments:
+            keys : List of (player ID, season) tuples
+        """
+        for player_id, season in keys:
+            try:
+                self.path(player_id, season).unlink()
+            except FileNotFoundError:
+                pass
+            except (IOError, OSError) as ex:
+                log.error("failed to remove columnar data: %s" % ex)
+
+    def files(self):
+        if not self.directory.exists():
+            return []
+        return list(self.directory.glob("*.nbac"))
+
+    def clear(self):
+        for path in self.files():
+            try:
+                path.unlink()
+            except (IOError, OSError) as ex:
+                log.error("failed to remove %s: %s" % (path, ex))
+
+    def disk_usage(self):
+        return sum(path.stat().st_size for path in self.files())
+
+
+def open_database(root):
+    """
+    Opens the local SQLite database, importing any data stored in the legacy
+    per-file JSON layout the first time it is opened.
+
+    Arguments:
+        root : Local storage directory as a pathlib.Path object
+
+    Returns:
+        the Database object
+    """
+    db = Database(root / DATABASE_NAME)
+    if db.get_meta("json_migrated") is None:
+        migrate_json(db, root)
+    return db
+
+
+def migrate_json(db, root):
+    """
+    Imports the teams, players, and player game stats stored as JSON files in
+    the local storage directory into the database. The files are left in place.
+
+    Arguments:
+        db   : Database object
+        root : Local storage directory as a pathlib.Path object
+    """
+    # files which are truncated/corrupt are skipped, and refetched once needed
+    path = root / "teams.json"
+    if path.exists():
+        db.store_teams(load_json(path) or [])
+    path = root / "players.json"
+    if path.exists():
+        db.store_players(load_json(path) or [])
+    pattern = re.compile(r"player_(\d+)_games_(\d+)\.json")
+    for path in root.glob("player_*_games_*.json"):
+        match = pattern.fullmatch(path.name)
+        if match is None:
+            continue
+        log.debug("importing %s" % path)
+        player_id, season = int(match.group(1)), int(match.group(2))
+        stats = load_json(path)
+        if stats is not None:
+            db.store_player_game_stats(player_id, season, stats)
+    db.set_meta("json_migrated", str(time.time()))
+
+
+class PageCounts:
+    """
+    Remembers the number of pages last observed for each paginated query, so
+    that the pages can be requested up front on the next run. Counts which
+    have not been observed recently are dropped, and at most MAX_PAGE_COUNTS
+    are kept.
+    """
+
+    def __init__(self, path, method=None):
+        self.path = path
+        # compression method, see store_json
+        self.method = method
+        # (page count, time observed) lists, by query
+        self.counts = None
+        self.dirty = False
+
+    def _loaded(self, counts):
+        # drop expired counts, along with counts stored by earlier versions
+        # without the time observed
+        now = time.time()
+        self.counts = {
+            key: value for key, value in (counts or {}).items()
+            if isinstance(value, list) and len(value) == 2
+            and now - value[1] < PAGE_COUNTS_TTL}
+        if len(self.counts) > MAX_PAGE_COUNTS:
+            newest = sorted(
+                self.counts.items(), key=lambda item: item[1][1],
+                reverse=True)
+            self.counts = dict(newest[:MAX_PAGE_COUNTS])
+        self.dirty = len(self.counts) != len(counts or {})
+
+    def load(self):
+        if self.counts is None:
+            self._loaded(load_json(self.path) if self.path.exists() else None)
+
+    async def load_async(self):
+        """
+        Loads the page counts without blocking the event loop.
+        """
+        if self.counts is None:
+            counts = None
+            if self.path.exists():
+                counts = await load_json_async(self.path)
+            self._loaded(counts)
+
+    def get(self, key):
+        """
+        Gets the last observed page count for the given query.
+
+        Arguments:
+            key : Normalized query URL, excluding pagination arguments
+
+        Returns:
+            the page count, or None if the query has not been seen
+        """
+        self.load()
+        value = self.counts.get(key)
+        return value[0] if value is not None else None
+
+    def set(self, key, pages):
+        """
+        Records the page count for the given query.
+
+        Arguments:
+            key   : Normalized query URL, excluding pagination arguments
+            pages : Page count
+        """
+        self.load()
+        now = time.time()
+        value = self.counts.get(key)
+        # unchanged counts are only re-stored once a day, to keep them from
+        # expiring
+        if (value is None or value[0] != pages
+                or now - value[1] > PAGE_COUNTS_REFRESH):
+            self.counts[key] = [pages, now]
+            self.dirty = True
+            if len(self.counts) > MAX_PAGE_COUNTS:
+                oldest = min(self.counts, key=lambda k: self.counts[k][1])
+                del self.counts[oldest]
+
+    def flush(self):
+        """
+        Stores the page counts if any have changed.
+        """
+        if self.dirty:
+            store_json(self.path, self.counts, self.method)
+            self.dirty = False
@@ -0,0 +1,160 @@
+# Copyright (C) 2022  Ian Brault
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import collections
+import time
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limiter whose limit adapts to the observed server behavior.
+
+    The limit follows an additive-increase/multiplicative-decrease scheme: it
+    grows by roughly one slot per window of requests while latency stays near
+    the best observed latency, shrinks gently when latency climbs, and is
+    halved when the server responds that requests are being throttled.
+    """
+
+    def __init__(
+        self,
+        max_limit, min_limit=1, initial=None, latency_tolerance=2.0,
+    ):
+        self.max_limit = max(max_limit, min_limit)
+        self.min_limit = min_limit
+        self.limit = float(initial if initial else min(4, self.max_limit))
+        self.latency_tolerance = latency_tolerance
+        # best observed latency and a smoothed recent latency, in seconds
+        self.min_latency = None
+        self.avg_latency = None
+        self.in_flight = 0
+        self._waiters = collections.deque()
+        self._last_backoff = 0.0
+
+    @property
+    def slots(self):
+        return max(self.min_limit, int(self.limit))
+
+    async def acquire(self):
+        """
+        Waits until a request slot is available and claims it.
+        """
+        while self.in_flight >= self.slots:
+            fut = asyncio.get_running_loop().create_future()
+            self._waiters.append(fut)
+            try:
+                await fut
+            except asyncio.CancelledError:
+                # pass the wakeup along if it was consumed by this waiter
+                if fut.done() and not fut.cancelled():
+                    self._wake()
+                elif fut in self._waiters:
+                    self._waiters.remove(fut)
+                raise
+        self.in_flight += 1
+
+    def release(self, latency, throttled=False):
+        """
+        Releases a request slot and adapts the limit.
+
+        Arguments:
+            latency   : Request latency in seconds
+            throttled : The server signaled that requests are being throttled
+        """
+        self.in_flight -= 1
+        if throttled:
+            self._backoff()
+        else:
+            self._observe(latency)
+        self._wake()
+
+    def _observe(self, latency):
+        if self.min_latency is None or latency < self.min_latency:
+            self.min_latency = latency
+        if self.avg_latency is None:
+            self.avg_latency = latency
+        else:
+            self.avg_latency = 0.8 * self.avg_latency + 0.2 * latency
+        if self.avg_latency <= self.min_latency * self.latency_tolerance:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        else:
+            self.limit = max(self.min_limit, self.limit * 0.95)
+
+    def _backoff(self):
+        # a burst of in-flight requests tends to be throttled together, only
+        # halve the limit once per round trip
+        now = time.monotonic()
+        if now - self._last_backoff < (self.avg_latency or 0.0):
+            return
+        self._last_backoff = now
+        self.limit = max(self.min_limit, self.limit / 2)
+
+    def _wake(self):
+        free = self.slots - self.in_flight
+        while free > 0 and self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                free -= 1
+
+
+class TokenBucket:
+    """
+    Token-bucket rate limiter. Tokens accrue at a fixed rate up to the bucket
+    capacity and each request consumes one, requests that arrive while the
+    bucket is empty reserve a future token and wait for it in arrival order.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self._updated = time.monotonic()
+
+    @classmethod
+    def for_budget(cls, limit, period, burst):
+        """
+        Creates a bucket which never exceeds the given server budget of limit
+        requests in any window of period seconds, allowing an initial burst.
+
+        Arguments:
+            limit  : Maximum number of requests per period
+            period : Budget period in seconds
+            burst  : Number of requests that can be made back-to-back
+
+        Returns:
+            the TokenBucket object
+        """
+        burst = max(1, min(burst, limit - 1))
+        return cls((limit - burst) / period, burst)
+
+    async def acquire(self):
+        """
+        Waits until a token is available and consumes it.
+        """
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self.tokens -= 1
+        if self.tokens < 0:
+            try:
+                await asyncio.sleep(-self.tokens / self.rate)
+            except asyncio.CancelledError:
+                # give back the reserved token, cancelled waiters i.e.
+                # speculative page requests would otherwise hold up later
+                # requests
+                self.tokens += 1
+                raise
@@ -59,6 +59,21 @@ def get_current_season():
     return year
 
 
+def is_season_over(season):
+    """
+    Checks if a season has ended, including the playoffs. The current season
+    moves on at the end of the regular season, see get_current_season, but
+    games are played until the NBA Finals end in June.
+
+    Arguments:
+        season : NBA season
+
+    Returns:
+        True if no more games will be played in the season
+    """
+    return datetime.datetime.now() >= datetime.datetime(season + 1, 7, 1)
+
+
 def min_to_number(mp):
     """
     Converts the given minutes played stat from clock format to a number.
@@ -114,3 +129,22 @@ def percentage(makes, attempts):
     if attempts == 0:
         return 0
     return (makes / attempts) * 100.0
+
+
+def format_size(size):
+    """
+    Formats a size in bytes for display.
+
+    Arguments:
+        size : Size in bytes
+
+    Returns:
+        the size as a str i.e. 12.3 MiB
+    """
+    if size < 1024:
+        return "%u B" % size
+    for unit in ["KiB", "MiB"]:
+        size /= 1024
+        if size < 1024:
+            return "%.1f %s" % (size, unit)
+    return "%.1f GiB" % (size / 1024)
@@ -14,9 +14,131 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from nba import __version__
+from nba import Game
+from nba import NBAState
+from nba import Player
+from nba import PlayerGameStats
+from nba import StatsTable
+from nba import Team
 from nba import api
+from nba.aggregates import PlayerAggregates
+from nba.aggregates import RunningStats
+from nba import cache_manager
+from nba import cli
+from nba import codec
+from nba import columnar
+from nba import compression
+from nba import response_cache
+from nba import search
+from nba import stats_table
+from nba import storage
+from nba import throttle
+from nba import utils
 
 import aiohttp
+import pytest
+import yarl
+
+import asyncio
+import datetime
+import importlib.util
+import itertools
+import json
+import pathlib
+import re
+import threading
+
+
+class FakeResponse:
+
+    def __init__(self, payload, status=200, headers=None):
+        self.payload = payload
+        self.status = status
+        self.headers = headers or {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def read(self):
+        return json.dumps(self.payload).encode("utf-8")
+
+
+class FakeSession:
+    """
+    Stands in for aiohttp.ClientSession, serving records from memory as
+    paginated responses.
+    """
+
+    def __init__(self, records, per_page=api.RESULTS_PER_PAGE, delay=0.0):
+        self.records = records
+        self.per_page = per_page
+        self.delay = delay
+        # queue of HTTP error statuses to fail the next requests with
+        self.failures = []
+        self.urls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def get(self, url, headers=None):
+        self.urls.append(url)
+        return self._respond(url, headers or {})
+
+    def _respond(self, url, headers):
+        session = self
+
+        class Context:
+            async def __aenter__(self):
+                session.in_flight += 1
+                session.max_in_flight = max(
+                    session.max_in_flight, session.in_flight)
+                try:
+                    await asyncio.sleep(session.delay)
+                finally:
+                    session.in_flight -= 1
+                if session.failures:
+                    info = aiohttp.RequestInfo(
+                        yarl.URL(url), "GET", {}, yarl.URL(url))
+                    raise aiohttp.ClientResponseError(
+                        info, (), status=session.failures.pop(0))
+                etag = '"%u"' % len(session.records)
+                if headers.get("If-None-Match") == etag:
+                    return FakeResponse(None, status=304)
+                return FakeResponse(session.page(url), headers={"ETag": etag})
+
+            async def __aexit__(self, *args):
+                pass
+
+        return Context()
+
+    def page(self, url):
+        match = re.search(r"[?&]page=(\d+)", url)
+        page = int(match.group(1)) if match else 1
+        records = self.records
+        player_ids = re.findall(r"player_ids\[\]=(\d+)", url)
+        if player_ids:
+            player_ids = set(int(player_id) for player_id in player_ids)
+            records = [
+                obj for obj in records if obj["player"]["id"] in player_ids]
+        seasons = re.findall(r"seasons\[\]=(\d+)", url)
+        if seasons:
+            seasons = set(int(season) for season in seasons)
+            records = [
+                obj for obj in records if obj["game"]["season"] in seasons]
+        total_pages = max(1, -(-len(records) // self.per_page))
+        start = (page - 1) * self.per_page
+        return {
+            "data": records[start:start + self.per_page],
+            "meta": {
+                "current_page": page,
+                "next_page": page + 1 if page < total_pages else None,
+                "per_page": self.per_page,
+                "total_count": len(records),
+                "total_pages": total_pages,
+            },
+        }
 
 
 def test_version():
@@ -37,3 +159,857 @@ def test_build_url():
     assert "b=Y" in result
     assert "c=Z" in result
     assert len([c for c in result if c == "&"]) == 2
+
+
+@pytest.mark.asyncio
+async def test_get_paginated_bounds_concurrency():
+    records = [{"id": i} for i in range(20 * api.RESULTS_PER_PAGE)]
+    session = FakeSession(records, delay=0.01)
+    api.configure(session, max_concurrency=3, rate_limit=None)
+    data = await api.get_paginated(session, "/api/v1/players")
+    assert data == records
+    assert session.max_in_flight <= 3
+
+
+@pytest.mark.asyncio
+async def test_adaptive_limiter_backoff():
+    limiter = throttle.AdaptiveLimiter(16, initial=8)
+    for _ in range(4):
+        await limiter.acquire()
+    # grows while latency is stable
+    limiter.release(0.1)
+    limiter.release(0.1)
+    assert limiter.limit > 8
+    # halves once for a burst of throttled responses
+    limit = limiter.limit
+    limiter.release(0.1, throttled=True)
+    limiter.release(0.1, throttled=True)
+    assert limiter.limit == pytest.approx(limit / 2)
+
+
+@pytest.mark.asyncio
+async def test_get_paginated_retries_failed_pages(monkeypatch):
+    monkeypatch.setattr(api, "RETRY_BACKOFF", 0.0)
+    records = [{"id": i} for i in range(3 * api.RESULTS_PER_PAGE)]
+    session = FakeSession(records)
+    api.configure(session, rate_limit=None)
+    session.failures = [503, 429]
+    data = await api.get_paginated(session, "/api/v1/players")
+    assert data == records
+    # the failed requests are retried individually
+    assert len(session.urls) == 5
+
+
+@pytest.mark.asyncio
+async def test_get_json_gives_up_on_client_errors():
+    session = FakeSession([])
+    api.configure(session, rate_limit=None)
+    session.failures = [404]
+    with pytest.raises(aiohttp.ClientResponseError):
+        await api.get_json(session, "/api/v1/players")
+    assert len(session.urls) == 1
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_spaces_requests():
+    bucket = throttle.TokenBucket.for_budget(limit=102, period=1.0, burst=2)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    for _ in range(7):
+        await bucket.acquire()
+    # 2 immediate requests followed by 5 spaced 10ms apart
+    assert loop.time() - start >= 0.045
+    # cancelled waiters give their tokens back
+    waiters = [asyncio.ensure_future(bucket.acquire()) for _ in range(40)]
+    await asyncio.sleep(0)
+    for waiter in waiters:
+        waiter.cancel()
+    await asyncio.gather(*waiters, return_exceptions=True)
+    start = loop.time()
+    await bucket.acquire()
+    assert loop.time() - start < 0.05
+
+
+def test_normalize_url():
+    a = api.build_url("/api/v1/stats", seasons=[2021, 2022], player_ids=[1])
+    b = api.build_url("/api/v1/stats", player_ids=[1], seasons=[2021, 2022])
+    assert a != b
+    assert response_cache.normalize_url(a) == response_cache.normalize_url(b)
+
+
+@pytest.mark.asyncio
+async def test_response_cache(tmp_path):
+    records = [{"id": i} for i in range(10)]
+    session = FakeSession(records)
+    cache = response_cache.ResponseCache(tmp_path)
+    api.configure(session, rate_limit=None, cache=cache)
+    threads = []
+    get = cache.get
+
+    def get_and_record(url):
+        threads.append(threading.current_thread().name)
+        return get(url)
+    cache.get = get_and_record
+    first = await api.get_json(session, "/api/v1/players", search="x")
+    # entries are read off the event loop
+    assert threads and threads[0].startswith("nba-responses")
+    cache.close()
+    # fresh entries are served without a request, also from a new process
+    session.records = []
+    api.configure(
+        session, rate_limit=None, cache=response_cache.ResponseCache(tmp_path))
+    assert await api.get_json(session, "/api/v1/players", search="x") == first
+    assert len(session.urls) == 1
+    # stale entries are revalidated
+    session.records = records
+    cache = response_cache.ResponseCache(tmp_path, ttls={"/api/v1/players": 0})
+    api.configure(session, rate_limit=None, cache=cache)
+    assert await api.get_json(session, "/api/v1/players", search="x") == first
+    assert len(session.urls) == 2
+
+
+def test_response_cache_eviction(tmp_path):
+    cache = response_cache.ResponseCache(tmp_path, max_size=1000)
+    for i in range(10):
+        cache.put("/api/v1/players?page=%u" % i, {"data": ["x" * 100]})
+    assert cache.disk_usage() <= 1000
+    assert cache.get("/api/v1/players?page=9") is not None
+    assert not cache.path("/api/v1/players?page=0").exists()
+
+
+@pytest.mark.asyncio
+async def test_get_json_coalesces_identical_requests():
+    records = [
+        {"id": i, "player": {"id": i % 2 + 1}, "game": {"season": 2022}}
+        for i in range(10)]
+    session = FakeSession(records, delay=0.01)
+    api.configure(session, rate_limit=None)
+    results = await asyncio.gather(
+        api.get_json(session, "/api/v1/stats", seasons=[2022], player_ids=[1]),
+        api.get_json(session, "/api/v1/stats", player_ids=[1], seasons=[2022]),
+        api.get_json(session, "/api/v1/stats", player_ids=[2], seasons=[2022]))
+    assert results[0] is results[1]
+    assert len(session.urls) == 2
+    # completed requests are not reused
+    await api.get_json(
+        session, "/api/v1/stats", seasons=[2022], player_ids=[1])
+    assert len(session.urls) == 3
+    # a request abandoned by every waiter is replaced, and the replacement is
+    # shared by later identical requests
+    abandoned = asyncio.ensure_future(api.get_json(
+        session, "/api/v1/stats", seasons=[2022], player_ids=[2]))
+    await asyncio.sleep(0.001)
+    abandoned.cancel()
+    await asyncio.sleep(0)
+    first = asyncio.ensure_future(api.get_json(
+        session, "/api/v1/stats", seasons=[2022], player_ids=[2]))
+    await asyncio.sleep(0.005)
+    second = asyncio.ensure_future(api.get_json(
+        session, "/api/v1/stats", seasons=[2022], player_ids=[2]))
+    assert (await first) is (await second)
+    assert len(session.urls) == 5
+
+
+@pytest.mark.asyncio
+async def test_iter_paginated():
+    records = [{"id": i} for i in range(5 * api.RESULTS_PER_PAGE)]
+    session = FakeSession(records)
+    api.configure(session, rate_limit=None)
+    pages = [
+        page async for page in api.iter_paginated(
+            session, "/api/v1/players", ordered=True)]
+    assert len(pages) == 5
+    assert list(itertools.chain.from_iterable(pages)) == records
+    unordered = [
+        obj async for obj in api.iter_paginated(
+            session, "/api/v1/players", records=True)]
+    assert sorted(unordered, key=lambda obj: obj["id"]) == records
+
+
+@pytest.mark.asyncio
+async def test_iter_paginated_close_cancels_requests():
+    records = [{"id": i} for i in range(5 * api.RESULTS_PER_PAGE)]
+    session = FakeSession(records, delay=0.01)
+    api.configure(session, rate_limit=None)
+    pages = api.iter_paginated(session, "/api/v1/players")
+    await pages.__anext__()
+    await pages.__anext__()
+    await pages.aclose()
+    await asyncio.sleep(0.05)
+    assert session.in_flight == 0
+    assert not api.get_session_state(session).pending
+
+
+@pytest.mark.asyncio
+async def test_get_players_game_stats(monkeypatch):
+    monkeypatch.setattr(api, "MAX_URL_LENGTH", 200)
+    player_ids = list(range(1000, 1020))
+    records = [
+        {"id": i, "player": {"id": player_id}, "game": {"season": season}}
+        for i, (player_id, season) in enumerate(
+            itertools.product(player_ids, [2021, 2022]))]
+    session = FakeSession(records, per_page=4)
+    api.configure(session, rate_limit=None)
+    stats = await api.get_players_game_stats(
+        session, player_ids, [2021, 2022])
+    # players are packed into as few requests as the URL limit allows
+    assert 1 < len(session.urls) < len(player_ids)
+    # lengths are measured on the URLs as they are sent, "[]" is encoded,
+    # including the page parameter
+    assert any("page=" in url for url in session.urls)
+    assert all(
+        len(str(yarl.URL(api.BASE_URL + url))) <= 200 for url in session.urls)
+    assert sorted(stats) == player_ids
+    assert all(len(stats[player_id]) == 2 for player_id in player_ids)
+    seasons = api.split_by_season(stats[1000])
+    assert sorted(seasons) == [2021, 2022]
+    # players which were not requested are skipped
+    records.append({"id": -1, "player": {"id": 1}, "game": {"season": 2021}})
+
+    async def get_paginated(session, url, **params):
+        return records
+    monkeypatch.setattr(api, "get_paginated", get_paginated)
+    stats = await api.get_players_game_stats(session, [1000], [2021])
+    assert list(stats) == [1000] and len(stats[1000]) == 2
+
+
+@pytest.mark.asyncio
+async def test_iter_paginated_remembers_page_counts(tmp_path, monkeypatch):
+    records = [{"id": i} for i in range(4 * api.RESULTS_PER_PAGE)]
+    session = FakeSession(records, delay=0.01)
+    page_counts = storage.PageCounts(tmp_path / "pages.json")
+    api.configure(session, rate_limit=None, page_counts=page_counts)
+    assert await api.get_paginated(session, "/api/v1/players") == records
+    page_counts.flush()
+    # all pages are requested up front on the next run
+    session = FakeSession(records, delay=0.01)
+    page_counts = storage.PageCounts(tmp_path / "pages.json")
+    api.configure(session, rate_limit=None, page_counts=page_counts)
+    assert await api.get_paginated(session, "/api/v1/players") == records
+    assert session.max_in_flight == 4
+    # over- and under-shoots are cleaned up
+    for count in (2, 6):
+        records = [{"id": i} for i in range(count * api.RESULTS_PER_PAGE)]
+        session = FakeSession(records)
+        api.configure(session, rate_limit=None, page_counts=page_counts)
+        assert await api.get_paginated(session, "/api/v1/players") == records
+    # date-bounded queries are not remembered
+    await api.get_paginated(
+        session, "/api/v1/stats", start_date="2023-01-01")
+    assert not any("start_date" in key for key in page_counts.counts)
+    # expired counts and counts from earlier versions are dropped
+    key = next(iter(page_counts.counts))
+    page_counts.counts["/api/v1/teams"] = 3
+    page_counts.counts[key][1] -= storage.PAGE_COUNTS_TTL
+    page_counts.dirty = True
+    page_counts.flush()
+    page_counts = storage.PageCounts(tmp_path / "pages.json")
+    assert page_counts.get(key) is None
+    assert page_counts.get("/api/v1/teams") is None
+    assert page_counts.dirty
+    # the most recently observed counts are kept
+    monkeypatch.setattr(storage, "MAX_PAGE_COUNTS", 2)
+    for i in range(3):
+        page_counts.set("/api/v1/players?page=%u" % i, i + 1)
+    assert len(page_counts.counts) == 2
+    assert page_counts.get("/api/v1/players?page=2") == 3
+
+
+CODEC_DOCUMENT = {
+    "data": [
+        {"id": 1, "min": "32:15", "fg_pct": 0.547, "player": None},
+        {"id": 2, "first_name": "Luka", "last_name": "Dončić", "pts": 1e3},
+    ],
+    "meta": {"next_page": None, "total_pages": 1, "flags": [True, False]},
+}
+
+
+@pytest.fixture(params=codec.available_backends())
+def codec_backend(request):
+    backend = codec.backend
+    codec.set_backend(request.param)
+    yield request.param
+    codec.set_backend(backend)
+
+
+def test_codec_backends(codec_backend):
+    encoded = codec.dumps(CODEC_DOCUMENT)
+    assert isinstance(encoded, bytes)
+    assert codec.loads(encoded) == CODEC_DOCUMENT
+    assert codec.loads(encoded.decode("utf-8")) == CODEC_DOCUMENT
+    # every backend produces the same document as the stdlib fallback
+    assert json.loads(encoded) == CODEC_DOCUMENT
+    assert codec.loads(json.dumps(CODEC_DOCUMENT).encode()) == CODEC_DOCUMENT
+    with pytest.raises(ValueError):
+        codec.loads(b"{\"data\": [")
+
+
+def test_storage_json_round_trip(codec_backend, tmp_path):
+    path = tmp_path / "data.json"
+    storage.store_json(path, CODEC_DOCUMENT)
+    assert storage.load_json(path) == CODEC_DOCUMENT
+
+
+@pytest.mark.parametrize("method", compression.available_methods())
+def test_storage_compression(method, tmp_path):
+    path = tmp_path / "data.json"
+    storage.store_json(path, CODEC_DOCUMENT, method)
+    data = path.read_bytes()
+    assert compression.is_framed(data)
+    assert storage.load_json(path) == CODEC_DOCUMENT
+    # truncated and corrupt files are detected rather than decoded
+    path.write_bytes(data[:-4])
+    assert storage.load_json(path) is None
+    path.write_bytes(data[:-1] + bytes([data[-1] ^ 0xff]))
+    assert storage.load_json(path) is None
+    # files written without compression by earlier versions are still loaded
+    path.write_bytes(json.dumps(CODEC_DOCUMENT).encode())
+    assert storage.load_json(path) == CODEC_DOCUMENT
+
+
+def test_response_cache_discards_corrupt_entries(tmp_path):
+    cache = response_cache.ResponseCache(tmp_path)
+    cache.put("/api/v1/teams", {"data": TEAMS_JSON})
+    path = cache.path("/api/v1/teams")
+    path.write_bytes(path.read_bytes()[:-8])
+    cache = response_cache.ResponseCache(tmp_path)
+    assert cache.get("/api/v1/teams") is None
+
+
+TEAMS_JSON = [
+    {"id": 1, "abbreviation": "BOS", "city": "Boston", "conference": "East",
+     "division": "Atlantic", "full_name": "Boston Celtics", "name": "Celtics"},
+    {"id": 14, "abbreviation": "LAL", "city": "Los Angeles",
+     "conference": "West", "division": "Pacific",
+     "full_name": "Los Angeles Lakers", "name": "Lakers"},
+]
+PLAYERS_JSON = [
+    {"id": 237, "first_name": "LeBron", "last_name": "James",
+     "position": "F", "team": TEAMS_JSON[1]},
+]
+
+
+def game_stats_json(player_id, season, ngames):
+    return [
+        {"id": season * 1000 + i, "player": {"id": player_id},
+         "ast": 8, "blk": 1, "dreb": 6, "fg3_pct": 0.4, "fg3a": 5, "fg3m": 2,
+         "fg_pct": 0.5, "fga": 20, "fgm": 10, "ft_pct": 0.75, "fta": 4,
+         "ftm": 3, "min": "0" if i % 5 == 4 else "35:%02u" % i, "oreb": 1,
+         "pf": 2, "pts": 25 + i, "reb": 7, "stl": 1, "turnover": 3,
+         "game": {"id": season * 1000 + i,
+                  "date": "%u-%02u-%02uT00:00:00.000Z" % (
+                      season + 1, 1 + i // 28, 1 + i % 28),
+                  "season": season, "home_team_id": 14, "home_team_score": 110,
+                  "visitor_team_id": 1 + 13 * (i % 2),
+                  "visitor_team_score": 100},
+         "team": TEAMS_JSON[1]}
+        for i in range(ngames)]
+
+
+def test_database_migrates_json_layout(tmp_path):
+    stats = game_stats_json(237, 2021, 10)
+    storage.store_json(tmp_path / "teams.json", TEAMS_JSON)
+    storage.store_json(tmp_path / "players.json", PLAYERS_JSON)
+    storage.store_json(tmp_path / "player_237_games_2021.json", stats)
+    storage.store_json(tmp_path / "player_237_games_2020.json", [])
+    db = storage.open_database(tmp_path)
+    assert db.load_teams() == TEAMS_JSON
+    assert db.load_players() == PLAYERS_JSON
+    assert db.load_player_game_stats(237, 2021) == stats
+    assert db.load_player_game_stats(237, 2020) == []
+    assert db.load_player_game_stats(237, 2019) is None
+    db.close()
+    # the migration only runs once
+    (tmp_path / "teams.json").unlink()
+    storage.store_json(tmp_path / "player_237_games_2019.json", [])
+    db = storage.open_database(tmp_path)
+    assert db.load_teams() == TEAMS_JSON
+    assert db.load_player_game_stats(237, 2019) is None
+    db.close()
+
+
+def test_database_merges_incremental_stats(tmp_path):
+    stats = game_stats_json(237, 2022, 10)
+    db = storage.open_database(tmp_path)
+    assert db.get_player_game_stats_mark(237, 2022) is None
+    db.store_player_game_stats(237, 2022, stats[:6])
+    mark = db.get_player_game_stats_mark(237, 2022)
+    assert mark == (stats[5]["game"]["date"], stats[5]["game"]["id"])
+    # the most recent game is re-fetched along with the new games
+    stats[5]["pts"] = 50
+    db.merge_player_game_stats(237, 2022, stats[5:])
+    assert db.load_player_game_stats(237, 2022) == stats
+    db.close()
+
+
+def test_database_tracks_complete_seasons(tmp_path, monkeypatch):
+    stats = game_stats_json(237, 2022, 10)
+    db = storage.open_database(tmp_path)
+    # a season stored while in progress is only synced until it ends
+    db.store_player_game_stats(237, 2022, stats[:4], complete=False)
+    db.touch_player_seasons([(237, 2022)], 100.0)
+    db.merge_player_game_stats(237, 2022, stats[4:8])
+    assert db.has_player_game_stats(237, 2022)
+    assert not db.has_player_game_stats(237, 2022, complete=True)
+    assert db.list_player_seasons()[0]["accessed"] == 100.0
+    # and then stored again in full
+    db.store_player_game_stats(237, 2022, stats)
+    assert db.has_player_game_stats(237, 2022, complete=True)
+    assert len(db.load_player_game_stats(237, 2022)) == 10
+    db.close()
+
+    class Now(datetime.datetime):
+        @classmethod
+        def now(cls):
+            return cls(2023, 5, 15)
+    monkeypatch.setattr(datetime, "datetime", Now)
+    # the previous season is no longer current but is still in the playoffs
+    assert utils.get_current_season() == 2023
+    assert not utils.is_season_over(2022)
+    assert utils.is_season_over(2021)
+
+
+def test_columnar_round_trip(tmp_path):
+    stats = game_stats_json(237, 2022, 30)
+    stats[3]["fg3_pct"] = None
+    stats[4]["pts"] = None
+    path = tmp_path / "player_237_games_2022.nbac"
+    storage.store_columnar(path, stats)
+    table = storage.load_columnar(path)
+    assert len(table) == 30
+    assert list(table.column("pts"))[:3] == [25, 26, 27]
+    assert len(table.tables["team"]) == 1
+    assert len(table.tables["game"]) == 30
+    assert table.toJSON() == stats
+    # truncated files are rejected
+    data = path.read_bytes()
+    with pytest.raises(columnar.FormatError):
+        columnar.decode(data[:len(data) // 2])
+    assert columnar.decode(columnar.encode([])).toJSON() == []
+
+
+def test_database_find_players(tmp_path):
+    players = [
+        {"id": 1, "first_name": "Anthony", "last_name": "Davis",
+         "position": "F-C", "team": TEAMS_JSON[1]},
+        {"id": 2, "first_name": "Anthony", "last_name": "Edwards",
+         "position": "G", "team": None},
+        {"id": 3, "first_name": "Lonnie", "last_name": "Walker IV",
+         "position": "G", "team": TEAMS_JSON[1]},
+    ]
+    db = storage.open_database(tmp_path)
+    db.store_players(players)
+    assert db.find_players(["anthony"]) == players[:2]
+    assert db.find_players(["Davis"]) == players[:1]
+    assert db.find_players(["ANTHONY", "davis"]) == players[:1]
+    assert db.find_players(["Lonnie", "Walker", "IV"]) == players[2:]
+    assert db.find_players(["Walker"]) == []
+    db.close()
+
+
+def test_state_tracks_dirty_players():
+    state = NBAState()
+    state.add_players([Player(**obj) for obj in PLAYERS_JSON], dirty=False)
+    assert state.pop_dirty_players() == []
+    # unchanged players are not dirty
+    state.add_player(Player(**PLAYERS_JSON[0]))
+    assert state.pop_dirty_players() == []
+    # new and changed players are dirty
+    changed = dict(PLAYERS_JSON[0], team=TEAMS_JSON[0])
+    state.add_player(Player(**changed))
+    state.add_player(Player(id=1, first_name="A", last_name="B", team=None))
+    dirty = state.pop_dirty_players()
+    assert [player.toJSON() for player in dirty] == [
+        {"id": 1, "first_name": "A", "last_name": "B", "position": None,
+         "team": None},
+        changed]
+    assert state.pop_dirty_players() == []
+    # serializing does not modify the player
+    assert state.players[0].toJSON() == changed
+    assert not isinstance(state.players[0].team, dict)
+
+
+def test_state_indexes():
+    state = NBAState()
+    players = [
+        {"id": 1, "first_name": "Anthony", "last_name": "Davis",
+         "team": TEAMS_JSON[1]},
+        {"id": 2, "first_name": "Anthony", "last_name": "Edwards"},
+        {"id": 3, "first_name": "Davis", "last_name": "Bertans"},
+    ]
+    state.add_players([Player(**obj) for obj in players])
+    state.set_teams([Team(**obj) for obj in TEAMS_JSON])
+    assert [p.id for p in state.filter_players(["anthony"])] == [1, 2]
+    assert [p.id for p in state.filter_players(["Davis"])] == [3, 1]
+    assert [p.id for p in state.filter_players(["ANTHONY", "davis"])] == [1]
+    assert [p.id for p in state.filter_players_by_prefix("ed")] == [2]
+    assert [p.id for p in state.filter_players_by_prefix("anthony d")] == [1]
+    # indexes are updated when a player changes
+    state.add_player(Player(id=2, first_name="Ant", last_name="Edwards"))
+    assert [p.id for p in state.filter_players(["anthony"])] == [1]
+    assert [p.id for p in state.filter_players_by_prefix("an")] == [2, 1]
+    assert state.get_player(2).first_name == "Ant"
+    assert [t.id for t in state.filter_teams("LAL")] == [14]
+    assert [t.id for t in state.filter_teams("Boston")] == [1]
+    assert state.team_id_to_abbreviation(14) == "LAL"
+    assert state.team_id_to_abbreviation(99) == ""
+
+
+def test_database_search_players(tmp_path):
+    players = [
+        {"id": 1, "first_name": "Luka", "last_name": "Dončić",
+         "position": "G", "team": None},
+        {"id": 2, "first_name": "Luka", "last_name": "Šamanić",
+         "position": "F", "team": None},
+        {"id": 3, "first_name": "Anthony", "last_name": "Davis",
+         "position": "F-C", "team": TEAMS_JSON[1]},
+    ]
+    db = storage.open_database(tmp_path)
+    db.store_players(players)
+    ranked = db.search_players("Doncic")
+    assert ranked[0] == (1.0, players[0])
+    assert search.best_match(ranked) == players[0]
+    assert db.search_players("luka doncci")[0][1] == players[0]
+    assert db.search_players("Antony Davs")[0][1] == players[2]
+    # similar names are only suggested, never picked
+    assert search.best_match(db.search_players("luka doncci")) is None
+    assert search.best_match(db.search_players("Anthony Edwards")) is None
+    assert [p["id"] for _, p in db.search_players("Luka")] == [1, 2]
+    assert search.best_match(db.search_players("Luka")) is None
+    assert db.search_players("Jokic") == []
+    assert db.search_players("Doncic", max_age=-1) == []
+    # stale candidates do not push out fresh ones
+    db.store_players([
+        dict(players[0], id=id, last_name="Dončić%u" % id)
+        for id in range(4, 10)])
+    db.conn.execute("UPDATE players SET updated = 0 WHERE id != 2")
+    ranked = db.search_players("Luka", max_age=60, limit=1)
+    assert [p["id"] for _, p in ranked] == [2]
+    db.close()
+
+
+def test_objects_share_teams_and_games():
+    stats_json = game_stats_json(237, 2022, 2)
+    stats = [PlayerGameStats(**obj) for obj in stats_json * 2]
+    assert stats[0].team is stats[1].team
+    assert stats[0].game is stats[2].game
+    assert stats[0].game is not stats[1].game
+    assert not hasattr(stats[0], "__dict__")
+    assert stats[0].toJSON()["game"] == stats_json[0]["game"]
+    # changed info creates a new object rather than modifying the shared one
+    game = dict(stats_json[0]["game"], home_team_score=120)
+    assert Game.intern(game) is not stats[0].game
+    assert stats[0].game.home_team_score == 110
+
+
+@pytest.fixture(params=["numpy", "array"])
+def stats_table_backend(request, monkeypatch):
+    if request.param == "array":
+        monkeypatch.setattr(stats_table, "numpy", None)
+    elif stats_table.numpy is None:
+        pytest.skip("numpy is not installed")
+    return request.param
+
+
+def test_stats_table(stats_table_backend):
+    stats_json = game_stats_json(237, 2022, 10)
+    stats_json[0]["blk"] = None
+    stats = [PlayerGameStats(**obj) for obj in stats_json]
+    table = StatsTable.from_stats(stats)
+    assert len(table) == 10
+    assert table.sum("blk") == 9
+    assert table.mean("pts") == pytest.approx(29.5)
+    assert table.percentage("ft_pct") == pytest.approx(75.0)
+    assert list(table.per36("pts"))[4] == 0
+    assert list(table.per36("pts"))[0] == pytest.approx(25 * 36 / 35)
+    played = table.without_dnp()
+    assert len(played) == 8
+    assert played.mean("pts") == pytest.approx(29.0)
+    averages = PlayerGameStats.average(stats, filter_dnp=True)
+    assert averages.gp == 8
+    assert averages.pts == pytest.approx(29.0)
+    assert averages.min == pytest.approx(played.mean("min"))
+    assert PlayerGameStats.average([]) is None
+
+
+def test_game_dates_are_parsed_once():
+    games = [
+        Game(id=2, date="2022-11-20T00:00:00.000Z"),
+        Game(id=1, date="2022-10-30T19:30:00.000Z"),
+        Game(id=3, date="2022-11-20T00:00:00Z"),
+    ]
+    assert games[0].date_to_datetime() == datetime.datetime(2022, 11, 20)
+    assert games[1].date_to_datetime().hour == 19
+    assert [g.id for g in sorted(games, key=lambda g: g.sort_key)] == [1, 2, 3]
+    assert "sort_key" not in games[0].toJSON()
+    assert Game().date_to_datetime() is None
+
+
+def test_player_aggregates():
+    stats = [
+        PlayerGameStats(**obj) for obj in game_stats_json(237, 2022, 30)]
+    aggregates = PlayerAggregates()
+    aggregates.extend(stats[:29])
+    aggregates.add(stats[29])
+    played = [s for s in stats if not s.is_dnp()]
+    assert aggregates.dnp == 6
+    assert len(aggregates.totals) == 24
+    assert aggregates.totals.mean("pts") == pytest.approx(
+        StatsTable.from_stats(played).mean("pts"))
+    assert aggregates.window(5).mean("pts") == pytest.approx(
+        StatsTable.from_stats(played[-5:]).mean("pts"))
+    assert aggregates.window(10).percentage("fg_pct") == pytest.approx(50.0)
+    # the player is at home in every game, alternating opponents
+    assert len(aggregates.home) == 24 and len(aggregates.away) == 0
+    assert len(aggregates.opponent(1)) + len(aggregates.opponent(14)) == 24
+    assert len(aggregates.opponent(99)) == 0
+    # updated games replace the previous stats
+    updated = dict(game_stats_json(237, 2022, 30)[28], pts=0)
+    aggregates.add(PlayerGameStats(**updated))
+    assert len(aggregates.totals) == 24
+    assert aggregates.window(5).sum("pts") == sum(
+        s.pts for s in played[-5:]) - played[-1].pts
+    # games added out of order rebuild the windows
+    aggregates = PlayerAggregates()
+    aggregates.extend(reversed(played))
+    assert aggregates.window(5).mean("pts") == pytest.approx(
+        StatsTable.from_stats(played[-5:]).mean("pts"))
+
+
+def test_database_merge_skips_unchanged_stats(tmp_path):
+    stats = game_stats_json(237, 2022, 5)
+    db = storage.open_database(tmp_path)
+    db.store_player_game_stats(237, 2022, stats)
+    changes = db.conn.total_changes
+    db.merge_player_game_stats(237, 2022, stats)
+    assert db.conn.total_changes == changes
+    db.close()
+
+
+def test_database_player_season_aggregates(tmp_path):
+    stats = game_stats_json(237, 2022, 10)
+    db = storage.open_database(tmp_path)
+    db.store_player_game_stats(237, 2022, stats)
+    assert db.load_player_season_aggregates(237, 2022) is None
+    table = StatsTable.from_stats(PlayerGameStats(**obj) for obj in stats)
+    played = table.without_dnp()
+    db.store_player_season_aggregates(237, 2022, 8, 2, played.sums())
+    aggregates = db.load_player_season_aggregates(237, 2022)
+    assert aggregates == {"games": 8, "dnp": 2, "sums": played.sums()}
+    totals = RunningStats.from_sums(aggregates["sums"], aggregates["games"])
+    assert totals.means() == pytest.approx(played.means())
+    assert totals.percentage("fg3_pct") == pytest.approx(40.0)
+    # unchanged games keep the aggregates, new games invalidate them
+    db.merge_player_game_stats(237, 2022, stats)
+    assert db.load_player_season_aggregates(237, 2022) is not None
+    db.merge_player_game_stats(237, 2022, game_stats_json(237, 2022, 11))
+    assert db.load_player_season_aggregates(237, 2022) is None
+    db.store_player_season_aggregates(237, 2022, 8, 2, played.sums())
+    db.delete_player_seasons([(237, 2022)])
+    assert db.load_player_season_aggregates(237, 2022) is None
+    db.close()
+
+
+@pytest.mark.asyncio
+async def test_async_storage(tmp_path):
+    path = tmp_path / "data.json"
+    storage.store_json(path, CODEC_DOCUMENT)
+    assert await storage.load_json_async(path) == CODEC_DOCUMENT
+    db = storage.open_database(tmp_path)
+    stats = game_stats_json(237, 2022, 5)
+    await db.run(db.store_player_game_stats, 237, 2022, stats)
+    results = await asyncio.gather(
+        db.run(db.load_player_game_stats, 237, 2022),
+        db.run(db.load_player_game_stats, 237, 2021))
+    assert results == [stats, None]
+    db.close()
+
+
+@pytest.fixture
+def script(tmp_path):
+    # the command-line script, using a database in the temporary directory
+    path = pathlib.Path(__file__).parent.parent / "nba.py"
+    spec = importlib.util.spec_from_file_location("nba_script", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.database = storage.open_database(tmp_path)
+    module.cache = cache_manager.CacheManager(module.database, tmp_path)
+    yield module
+    module.database.close()
+
+
+async def collect_newest_first(script, session, seasons, ngames=None):
+    games = []
+    game_stats = script.iter_player_game_stats_newest_first(
+        session, 237, seasons)
+    async for stats in game_stats:
+        games.append(stats)
+        if len(games) == ngames:
+            break
+    await game_stats.aclose()
+    return games
+
+
+@pytest.mark.asyncio
+async def test_newest_first_prefetches_stored_seasons(script, monkeypatch):
+    records = game_stats_json(237, 2019, 10) + game_stats_json(237, 2018, 10)
+    session = FakeSession(records, delay=0.05)
+    api.configure(session, rate_limit=None)
+    script.database.store_player_game_stats(
+        237, 2017, game_stats_json(237, 2017, 10))
+    # the stored season is loaded while the missing seasons are fetched
+    loads = []
+    load = script.load_player_game_stats_json
+
+    def load_and_record(player_id, season):
+        loads.append((season, session.in_flight))
+        return load(player_id, season)
+    monkeypatch.setattr(script, "load_player_game_stats_json", load_and_record)
+    games = await collect_newest_first(script, session, [2017, 2018, 2019])
+    assert [stats.game.season for stats in games] == sorted(
+        [2017, 2018, 2019] * 10, reverse=True)
+    assert [stats.id for stats in games[:10]] == list(
+        range(2019009, 2018999, -1))
+    assert (2017, 1) in loads
+    # a single request for both missing seasons
+    assert len(session.urls) == 1
+
+
+@pytest.mark.asyncio
+async def test_newest_first_stops_early(script):
+    season = utils.get_current_season()
+    records = game_stats_json(237, season, 10)
+    for prev in range(season - 3, season):
+        records += game_stats_json(237, prev, 10)
+    session = FakeSession(records)
+    api.configure(session, rate_limit=None)
+    seasons = range(season - 3, season + 1)
+    games = await collect_newest_first(script, session, seasons, ngames=5)
+    assert [stats.id for stats in games] == [
+        season * 1000 + i for i in range(9, 4, -1)]
+    # only the current season was requested
+    assert len(session.urls) == 1
+    assert "seasons[]=%u" % season in session.urls[0]
+    assert "seasons[]=%u" % (season - 1) not in session.urls[0]
+    # the previous seasons are then requested in a single query
+    games = await collect_newest_first(script, session, seasons, ngames=15)
+    assert games[-1].game.season == season - 1
+    assert len(session.urls) == 2
+    assert all(
+        "seasons[]=%u" % prev in session.urls[1]
+        for prev in range(season - 3, season))
+
+
+@pytest.mark.asyncio
+async def test_game_log_without_games(script, caplog):
+    session = FakeSession(game_stats_json(237, utils.get_current_season(), 5))
+    api.configure(session, rate_limit=None)
+    player = Player(**PLAYERS_JSON[0])
+
+    async def get_player(args, session):
+        return player
+    script.get_player = get_player
+    args = cli.parse_args(["games", "-n", "0", "LeBron"])
+    await script.player_game_log(args, session)
+    assert session.urls == []
+    assert "no games found" in caplog.text
+
+
+def test_cache_manager_expires_and_evicts(tmp_path):
+    db = storage.open_database(tmp_path)
+    db.store_teams(TEAMS_JSON)
+    db.store_players(PLAYERS_JSON)
+    for season in range(2015, 2021):
+        db.store_player_game_stats(
+            237, season, game_stats_json(237, season, 50))
+    cache = cache_manager.CacheManager(db, tmp_path, ttls={"players": 0})
+    assert cache.is_fresh("teams", db.get_teams_updated())
+    assert db.find_players(["LeBron"], max_age=cache.ttl("players")) == []
+    assert db.find_players(["LeBron"]) == PLAYERS_JSON
+    # the least-recently-used seasons are evicted first
+    cache.access(237, 2015)
+    cache.record("historical", True)
+    cache.record("historical", False)
+    cache.flush()
+    cache.evict(target=db.size() // 2)
+    assert db.has_player_game_stats(237, 2015)
+    assert not db.has_player_game_stats(237, 2016)
+    assert cache.usage()["hits"]["historical"] == [1, 1]
+    # the maximum size is kept for later runs
+    cache.set_max_size(1024)
+    assert cache_manager.CacheManager(db, tmp_path).max_size == 1024
+    # expired seasons are removed by compaction
+    cache.ttls["historical"] = 0
+    remaining = db.count("player_seasons")
+    assert cache.compact()["expired"] == remaining
+    assert db.count("player_seasons") == 0
+    assert db.count("games") == 0
+    db.close()
+
+
+def test_cache_manager_bounds_all_local_storage(tmp_path):
+    db = storage.open_database(tmp_path)
+    responses = response_cache.ResponseCache(tmp_path / "http")
+    cache = cache_manager.CacheManager(db, tmp_path, responses=responses)
+    for season in range(2015, 2021):
+        cache.store_player_game_stats(
+            237, season, game_stats_json(237, season, 50), True)
+    cache.set_columnar(True)
+    for season in range(2015, 2021):
+        cache.load_player_game_stats(237, season)
+    for i in range(20):
+        responses.put("/api/v1/teams?page=%u" % i, TEAMS_JSON)
+    (tmp_path / cache_manager.PAGE_COUNTS).write_text("{}")
+    usage = cache.usage()
+    assert usage["columnar"] > 0 and usage["responses"] > 0
+    assert usage["total"] == (
+        usage["database"] + usage["columnar"] + usage["responses"]
+        + usage["pages"])
+    # the maximum size also bounds the response cache
+    cache.set_max_size(1024)
+    assert responses.max_size == 1024
+    # cached responses are evicted before player seasons
+    cache.evict(target=usage["total"] - usage["responses"] // 2)
+    assert 0 < cache.usage()["response_files"] < 20
+    assert db.count("player_seasons") == 6
+    cache.evict(target=usage["database"])
+    assert cache.usage()["response_files"] == 0
+    assert db.count("player_seasons") < 6
+    assert len(cache.columnar.files()) == db.count("player_seasons")
+    db.close()
+
+
+def test_cache_manager_columnar_seasons(tmp_path):
+    db = storage.open_database(tmp_path)
+    cache = cache_manager.CacheManager(db, tmp_path)
+    cache.store_player_game_stats(
+        237, 2020, game_stats_json(237, 2020, 10), True)
+    cache.store_player_game_stats(
+        237, 2021, game_stats_json(237, 2021, 10), False)
+    expected = db.load_player_game_stats(237, 2020)
+    assert cache.load_player_game_stats(237, 2020) == expected
+    assert cache.columnar.files() == []
+    # complete seasons are written to the columnar files on first load
+    cache.set_columnar(True)
+    assert cache_manager.CacheManager(db, tmp_path).use_columnar
+    assert cache.load_player_game_stats(237, 2020) == expected
+    assert cache.load_player_game_stats(237, 2021) is not None
+    path = cache.columnar.path(237, 2020)
+    assert cache.columnar.files() == [path]
+    assert cache.columnar.load(237, 2020) == expected
+    assert cache.load_player_game_stats(237, 2020) == expected
+    # corrupt files fall back to the database
+    path.write_bytes(path.read_bytes()[:64])
+    assert cache.load_player_game_stats(237, 2020) == expected
+    # refetched seasons replace the columnar copy
+    cache.store_player_game_stats(
+        237, 2020, game_stats_json(237, 2020, 5), True)
+    assert not path.exists()
+    assert len(cache.load_player_game_stats(237, 2020)) == 5
+    assert path.exists()
+    cache.delete_player_seasons([(237, 2020)])
+    assert not path.exists()
+    cache.load_player_game_stats(237, 2020)
+    cache.set_columnar(False)
+    assert cache.columnar.files() == []
+    db.close()